@@ -1,9 +1,20 @@
 import os
+import re
+import atexit
+import bisect
 import sqlite3
 import uuid
+import math
 import random
 import string
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import threading
+import time
+import csv
+import io
+import json
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from datetime import datetime
@@ -18,6 +29,11 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Password hashing: the method carries the work factor (scrypt:N:r:p or pbkdf2:sha256:iterations).
+# Stored hashes made with other parameters are upgraded at the user's next login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('MEDIPLANT_PASSWORD_HASH', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('MEDIPLANT_PASSWORD_HASH_WORKERS', 2))
+
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
@@ -50,26 +66,1132 @@ def update_product_rating(product_id):
     
     conn.commit()
     conn.close()
+    invalidate_reviews(product_id)
+    refresh_facets([product_id])
+    update_featured_products([product_id])
+
+# Review paging
+REVIEWS_PER_PAGE = 10
+REVIEW_SORTS = {
+    # sort name: (ORDER BY, keyset condition for rows after the cursor)
+    'newest': ('r.created_at DESC, r.id DESC',
+               '(r.created_at, r.id) < (?, ?)'),
+    'highest': ('r.rating DESC, r.created_at DESC, r.id DESC',
+                '(r.rating, r.created_at, r.id) < (?, ?, ?)'),
+    'lowest': ('r.rating ASC, r.created_at DESC, r.id DESC',
+               '(r.rating > ? OR (r.rating = ? AND (r.created_at, r.id) < (?, ?)))'),
+}
+
+def encode_review_cursor(review, sort):
+    if sort == 'newest':
+        return f"{review['created_at']}|{review['id']}"
+    return f"{review['rating']}|{review['created_at']}|{review['id']}"
+
+def decode_review_cursor(cursor, sort):
+    """Turn a cursor back into keyset parameters; raises ValueError if malformed"""
+    parts = cursor.split('|')
+    if sort == 'newest':
+        created_at, review_id = parts
+        return [created_at, int(review_id)]
+    rating, created_at, review_id = parts
+    if sort == 'lowest':
+        return [int(rating), int(rating), created_at, int(review_id)]
+    return [int(rating), created_at, int(review_id)]
 
-def calculate_order_total(subtotal):
-    """Calculate final order total with taxes and shipping"""
-    shipping = 0 if subtotal >= FREE_SHIPPING_THRESHOLD else SHIPPING_CHARGE
-    gst = subtotal * GST_RATE
-    total = subtotal + shipping + gst
+def fetch_reviews_page(conn, product_id, sort='newest', cursor=None, limit=REVIEWS_PER_PAGE):
+    """Return one page of reviews and the cursor for the next page (None on the last page)"""
+    order_by, after = REVIEW_SORTS[sort]
+    query = '''
+        SELECT r.*, u.username, u.full_name
+        FROM reviews r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.product_id = ?
+    '''
+    params = [product_id]
     
-    return {
-        'subtotal': subtotal,
-        'shipping': shipping,
-        'gst': gst,
-        'total': total,
-        'free_shipping_threshold': FREE_SHIPPING_THRESHOLD
-    }
+    if cursor:
+        query += ' AND ' + after
+        params.extend(decode_review_cursor(cursor, sort))
+    
+    query += f' ORDER BY {order_by} LIMIT ?'
+    params.append(limit + 1)
+    
+    reviews = conn.execute(query, params).fetchall()
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        next_cursor = encode_review_cursor(reviews[-1], sort)
+    return reviews, next_cursor
+
+# Co-purchase recommendations
+RECOMMENDATION_TOP_K = 8  # neighbours stored per product
+RECOMMENDATION_BATCH_ORDERS = 5000  # orders counted per transaction during a rebuild
+
+def pack_product_ids(product_ids):
+    return ','.join(str(product_id) for product_id in product_ids)
+
+def unpack_product_ids(packed):
+    return [int(product_id) for product_id in packed.split(',') if product_id]
+
+def refresh_recommendations(conn, product_ids):
+    """Recompute the stored top-K neighbour list for the given products"""
+    for product_id in set(product_ids):
+        neighbours = [row['other_product_id'] for row in conn.execute('''
+            SELECT other_product_id FROM product_copurchases
+            WHERE product_id = ?
+            ORDER BY pair_count DESC, other_product_id
+            LIMIT ?
+        ''', (product_id, RECOMMENDATION_TOP_K)).fetchall()]
+        conn.execute('''
+            INSERT INTO product_recommendations (product_id, neighbours, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (product_id) DO UPDATE SET
+                neighbours = excluded.neighbours, updated_at = excluded.updated_at
+        ''', (product_id, pack_product_ids(neighbours)))
+
+def record_copurchases(conn, product_ids):
+    """Count every product pair of a new order; runs inside place_order's transaction"""
+    product_ids = sorted(set(int(product_id) for product_id in product_ids))
+    if len(product_ids) < 2:
+        return
+    
+    conn.executemany('''
+        INSERT INTO product_copurchases (product_id, other_product_id, pair_count)
+        VALUES (?, ?, 1)
+        ON CONFLICT (product_id, other_product_id) DO UPDATE SET pair_count = pair_count + 1
+    ''', [(a, b) for a in product_ids for b in product_ids if a != b])
+    refresh_recommendations(conn, product_ids)
+
+def rebuild_recommendations(conn):
+    """Recount all co-purchase pairs from order history in batches of orders"""
+    conn.execute('DELETE FROM product_copurchases')
+    conn.execute('DELETE FROM product_recommendations')
+    conn.commit()
+    
+    bounds = conn.execute('SELECT MIN(order_id) as low, MAX(order_id) as high FROM order_items').fetchone()
+    if bounds['low'] is None:
+        return 0
+    
+    # Each batch counts its pairs with one grouped self-join and folds them in
+    for start in range(bounds['low'], bounds['high'] + 1, RECOMMENDATION_BATCH_ORDERS):
+        conn.execute('''
+            INSERT INTO product_copurchases (product_id, other_product_id, pair_count)
+            SELECT a.product_id, b.product_id, COUNT(DISTINCT a.order_id)
+            FROM order_items a
+            JOIN order_items b ON a.order_id = b.order_id AND a.product_id != b.product_id
+            WHERE a.order_id >= ? AND a.order_id < ?
+            GROUP BY a.product_id, b.product_id
+            ON CONFLICT (product_id, other_product_id) DO UPDATE SET
+                pair_count = pair_count + excluded.pair_count
+        ''', (start, start + RECOMMENDATION_BATCH_ORDERS))
+        conn.commit()
+    
+    # Stream pairs in rank order and keep the first K per product
+    rows = conn.execute('''
+        SELECT product_id, other_product_id FROM product_copurchases
+        ORDER BY product_id, pair_count DESC, other_product_id
+    ''')
+    lists = {}
+    for row in rows:
+        neighbours = lists.setdefault(row['product_id'], [])
+        if len(neighbours) < RECOMMENDATION_TOP_K:
+            neighbours.append(row['other_product_id'])
+    
+    conn.executemany(
+        'INSERT INTO product_recommendations (product_id, neighbours) VALUES (?, ?)',
+        [(product_id, pack_product_ids(neighbours)) for product_id, neighbours in lists.items()]
+    )
+    conn.commit()
+    return len(lists)
+
+def get_recommended_products(conn, product_ids, limit=4):
+    """Active products frequently bought with any of product_ids, best matches first"""
+    product_ids = [int(product_id) for product_id in product_ids]
+    if not product_ids:
+        return []
+    
+    placeholders = ','.join('?' * len(product_ids))
+    rows = conn.execute(f'''
+        SELECT neighbours FROM product_recommendations WHERE product_id IN ({placeholders})
+    ''', product_ids).fetchall()
+    
+    candidates = []
+    for row in rows:
+        for neighbour in unpack_product_ids(row['neighbours']):
+            if neighbour not in product_ids and neighbour not in candidates:
+                candidates.append(neighbour)
+    if not candidates:
+        return []
+    
+    placeholders = ','.join('?' * len(candidates))
+    products_by_id = {row['id']: row for row in conn.execute(f'''
+        SELECT * FROM products WHERE id IN ({placeholders}) AND is_active = 1
+    ''', candidates).fetchall()}
+    return [products_by_id[product_id] for product_id in candidates if product_id in products_by_id][:limit]
+
+# Typeahead search
+SEARCH_SUGGESTION_LIMIT = 5  # suggestions returned per kind
+SEARCH_SUGGESTION_SCAN = 50  # index entries examined per prefix before ranking
+
+def normalize_search_text(text):
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+class PrefixIndex:
+    """Sorted in-memory index of product and category names for typeahead.
+
+    Every word-start suffix of a name is a key, so "tul" finds "Holy Basil
+    (Tulsi)". A lookup is a bisect plus a short forward scan.
+    """
+
+    def __init__(self, entries=()):
+        """Index (kind, id, name, weight) entries, sorting the keys once"""
+        self._items = {}  # (kind, id) -> (name, weight, terms)
+        keys = []
+        for kind, item_id, name, weight in entries:
+            terms = self._terms(name)
+            self._items[(kind, item_id)] = (name, weight, terms)
+            keys.extend((term, kind, item_id) for term in terms)
+        keys.sort()
+        self._keys = keys  # sorted (term, kind, id)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _terms(name):
+        words = normalize_search_text(name).split()
+        return {' '.join(words[i:]) for i in range(len(words))}
+
+    def add(self, kind, item_id, name, weight=0):
+        with self._lock:
+            item = self._items.get((kind, item_id))
+            if item is not None and item[:2] == (name, weight):
+                return
+            self._remove(kind, item_id)
+            terms = self._terms(name)
+            self._items[(kind, item_id)] = (name, weight, terms)
+            for term in terms:
+                bisect.insort(self._keys, (term, kind, item_id))
+
+    def remove(self, kind, item_id):
+        with self._lock:
+            self._remove(kind, item_id)
+
+    def ids(self, kind):
+        with self._lock:
+            return [item_id for item_kind, item_id in self._items if item_kind == kind]
+
+    def _remove(self, kind, item_id):
+        item = self._items.pop((kind, item_id), None)
+        if item is None:
+            return
+        for term in item[2]:
+            i = bisect.bisect_left(self._keys, (term, kind, item_id))
+            if i < len(self._keys) and self._keys[i] == (term, kind, item_id):
+                del self._keys[i]
+
+    def search(self, prefix, limit=SEARCH_SUGGESTION_LIMIT):
+        prefix = normalize_search_text(prefix)
+        results = {'product': [], 'category': []}
+        if not prefix:
+            return results
+        
+        with self._lock:
+            matches = {}
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(matches) < SEARCH_SUGGESTION_SCAN:
+                term, kind, item_id = self._keys[i]
+                if not term.startswith(prefix):
+                    break
+                matches[(kind, item_id)] = self._items[(kind, item_id)]
+                i += 1
+        
+        for (kind, item_id), (name, weight, _) in sorted(matches.items(), key=lambda m: (-m[1][1], m[1][0])):
+            if len(results[kind]) < limit:
+                results[kind].append({'id': item_id, 'name': name})
+        return results
+
+search_index = None
+search_index_lock = threading.Lock()
+search_index_pending = None  # while a background rebuild runs: product ids written meanwhile
+
+def product_search_weight(product):
+    return (product['average_rating'] or 0) * (product['total_reviews'] or 0)
+
+def load_search_index():
+    """Every active product and category name in a fresh PrefixIndex"""
+    conn = get_db_connection()
+    entries = [('product', product['id'], product['name'], product_search_weight(product))
+               for product in conn.execute('''
+                   SELECT id, name, average_rating, total_reviews FROM products WHERE is_active = 1
+               ''')]
+    entries += [('category', category['id'], category['name'], 0)
+                for category in conn.execute('SELECT id, name FROM categories')]
+    conn.close()
+    return PrefixIndex(entries)
+
+def build_search_index():
+    """Build the index in the foreground, at startup before requests are served"""
+    global search_index
+    search_index = load_search_index()
+    return search_index
+
+def rebuild_search_index_in_background():
+    """Swap in a fresh index while typeahead keeps answering from the current one"""
+    global search_index_pending
+    with search_index_lock:
+        if search_index_pending is not None:
+            search_index_pending.add(None)  # the running build may have missed this; go again
+            return
+        search_index_pending = set()
+    threading.Thread(target=run_search_index_rebuild, name='search-index', daemon=True).start()
+
+def run_search_index_rebuild():
+    global search_index, search_index_pending
+    while True:
+        index = load_search_index()
+        with search_index_lock:
+            pending, search_index_pending = search_index_pending, set()
+            if None not in pending:
+                search_index = index
+                search_index_pending = None
+                break
+    if pending:
+        # Products written while the index was loading, re-read into the new one
+        reindex_products_for_search(pending)
+
+def get_search_index():
+    if search_index is None:
+        # Not built at startup (e.g. another WSGI server): keystrokes get no suggestions
+        # for the moment it takes rather than waiting for it
+        rebuild_search_index_in_background()
+        return PrefixIndex()
+    return search_index
+
+def index_product_for_search(product_id, name, is_active=True, weight=0):
+    """Keep the typeahead index in step with a product write (no-op until it is built).
+
+    Writes from other processes reach it through apply_catalog_changes.
+    """
+    index = search_index
+    if search_index_pending is not None:
+        search_index_pending.add(int(product_id))
+    if index is None:
+        return
+    if is_active:
+        index.add('product', int(product_id), name, weight)
+    else:
+        index.remove('product', int(product_id))
+
+def reindex_products_for_search(product_ids):
+    """Re-read products into the typeahead index, dropping ones that are gone or inactive"""
+    product_ids = [int(product_id) for product_id in product_ids]
+    if search_index is None or not product_ids:
+        return
+    rows = {row['id']: row for row in query_all(f'''
+        SELECT id, name, is_active, average_rating, total_reviews
+        FROM products WHERE id IN ({','.join('?' * len(product_ids))})
+    ''', product_ids)}
+    for product_id in product_ids:
+        row = rows.get(product_id)
+        if row and row['is_active']:
+            index_product_for_search(product_id, row['name'], weight=product_search_weight(row))
+        else:
+            index_product_for_search(product_id, None, is_active=False)
+
+def index_categories_for_search():
+    """Re-read category names into the typeahead index after a category write"""
+    index = search_index
+    if index is None:
+        return
+    categories = {row['id']: row['name'] for row in query_all('SELECT id, name FROM categories')}
+    for category_id in index.ids('category'):
+        if category_id not in categories:
+            index.remove('category', category_id)
+    for category_id, name in categories.items():
+        index.add('category', category_id, name)
+
+# Catalog facets
+PRICE_BUCKETS = [
+    # key, label, low (inclusive), high (exclusive)
+    ('under-250', 'Under ₹250', 0, 250),
+    ('250-500', '₹250 - ₹500', 250, 500),
+    ('500-1000', '₹500 - ₹1,000', 500, 1000),
+    ('1000-2000', '₹1,000 - ₹2,000', 1000, 2000),
+    ('2000-plus', 'Over ₹2,000', 2000, None),
+]
+RATING_FACETS = [4, 3, 2, 1]  # "N stars & up"
+
+def price_bucket(price):
+    for key, label, low, high in PRICE_BUCKETS:
+        if price >= low and (high is None or price < high):
+            return key
+    return None
+
+class FacetIndex:
+    """Compact bitsets over the active catalog, one per facet value.
+
+    Bit i stands for the i-th oldest product, so a filter combination is an
+    AND of ints, a facet count is a popcount and a new product is one more bit.
+    """
+
+    def __init__(self, products):
+        self.product_ids = [product['id'] for product in products]  # oldest first
+        self.positions = {product_id: i for i, product_id in enumerate(self.product_ids)}
+        self.newest = self._order(products[-1]) if products else ('', 0)
+        self.active = 0
+        self.bits = {'category': {}, 'price': {}, 'rating': {}, 'in_stock': {}}
+        self._lock = threading.Lock()
+        for product in products:
+            self._set(product, True)
+
+    @staticmethod
+    def _order(product):
+        return (product['created_at'] or '', product['id'])
+
+    def _values(self, product):
+        rating = product['average_rating'] or 0
+        return {
+            'category': [product['category_id']],
+            'price': [price_bucket(product['price'])],
+            'rating': [stars for stars in RATING_FACETS if rating >= stars],
+            'in_stock': [True] if product['stock_quantity'] > 0 else [],
+        }
+
+    def _set(self, product, on):
+        bit = 1 << self.positions[product['id']]
+        if on:
+            self.active |= bit
+        else:
+            self.active &= ~bit
+        for facet, values in self._values(product).items():
+            for value in values:
+                current = self.bits[facet].get(value, 0)
+                self.bits[facet][value] = current | bit if on else current & ~bit
+
+    def replace(self, product_id, product):
+        """Clear an indexed product's bits and set them again from its current row"""
+        mask = ~(1 << self.positions[product_id])
+        with self._lock:
+            self.active &= mask
+            for values in self.bits.values():
+                for value in values:
+                    values[value] &= mask
+            if product is not None and product['is_active']:
+                self._set(product, True)
+
+    def append(self, product):
+        """Index a product listed after every indexed one; False if it sorts earlier"""
+        with self._lock:
+            if self._order(product) <= self.newest:
+                return False
+            self.positions[product['id']] = len(self.product_ids)
+            self.product_ids.append(product['id'])
+            self.newest = self._order(product)
+            self._set(product, True)
+        return True
+
+    def bits_for_ids(self, product_ids):
+        bits = 0
+        for product_id in product_ids:
+            if product_id in self.positions:
+                bits |= 1 << self.positions[product_id]
+        return bits
+
+    def query(self, filters, restrict=None):
+        """Apply {facet: value} filters; return (matching bits, counts per facet value).
+
+        Counts for a facet ignore that facet's own filter, so every option
+        shows how many products selecting it would give.
+        """
+        with self._lock:
+            base = self.active if restrict is None else self.active & restrict
+            selected = {facet: self.bits[facet].get(value, 0) for facet, value in filters.items()}
+            
+            result = base
+            for bits in selected.values():
+                result &= bits
+            
+            counts = {}
+            for facet, values in self.bits.items():
+                others = base
+                for other_facet, bits in selected.items():
+                    if other_facet != facet:
+                        others &= bits
+                counts[facet] = {value: (others & bits).bit_count() for value, bits in values.items()}
+        return result, counts
+
+    def page(self, bits, offset, limit):
+        """Product ids of the set bits newest first, skipping the first offset"""
+        ids = []
+        position = 0
+        while bits and len(ids) < limit:
+            top = bits.bit_length() - 1
+            if position >= offset:
+                ids.append(self.product_ids[top])
+            position += 1
+            bits ^= 1 << top
+        return ids
+
+facet_index = None
+facet_index_lock = threading.Lock()
+facet_index_pending = None  # while a background rebuild runs: product ids written meanwhile
+FACET_COLUMNS = 'id, category_id, price, stock_quantity, average_rating, is_active, created_at'
+
+def load_facet_index():
+    conn = get_db_connection()
+    products = conn.execute(f'''
+        SELECT {FACET_COLUMNS} FROM products
+        WHERE is_active = 1
+        ORDER BY created_at, id
+    ''').fetchall()
+    conn.close()
+    return FacetIndex(products)
+
+def build_facet_index():
+    """Build the index in the foreground, at startup before requests are served"""
+    global facet_index
+    facet_index = load_facet_index()
+    return facet_index
+
+def rebuild_facet_index_in_background():
+    """Swap in a fresh index while /products keeps filtering with the current one"""
+    global facet_index_pending
+    with facet_index_lock:
+        if facet_index_pending is not None:
+            facet_index_pending.add(None)  # the running build may have missed this; go again
+            return
+        facet_index_pending = set()
+    threading.Thread(target=run_facet_index_rebuild, name='facet-index', daemon=True).start()
+
+def run_facet_index_rebuild():
+    global facet_index, facet_index_pending
+    while True:
+        index = load_facet_index()
+        with facet_index_lock:
+            pending, facet_index_pending = facet_index_pending, set()
+            if None not in pending:
+                facet_index = index
+                facet_index_pending = None
+                break
+    if pending:
+        # Products written while the index was loading, re-read into the new one
+        refresh_facets(pending)
+
+def get_facet_index():
+    if facet_index is None:
+        with facet_index_lock:
+            if facet_index is None:
+                # Not built at startup (e.g. another WSGI server) and nothing to serve from yet
+                build_facet_index()
+    return facet_index
+
+def refresh_facets(product_ids):
+    """Re-read the given products and update their facet bits in place.
+
+    New products are appended; only one listed before already indexed products
+    (e.g. imported with an older created_at) needs a rebuild, done in the background.
+    Writes from other processes reach the index through apply_catalog_changes.
+    """
+    product_ids = list({int(product_id) for product_id in product_ids})
+    index = facet_index
+    if facet_index_pending is not None:
+        facet_index_pending.update(product_ids)
+    if index is None or not product_ids:
+        return
+    
+    conn = get_db_connection()
+    rows = {row['id']: row for row in conn.execute(f'''
+        SELECT {FACET_COLUMNS} FROM products WHERE id IN ({','.join('?' * len(product_ids))})
+    ''', product_ids).fetchall()}
+    conn.close()
+    
+    added = []
+    for product_id in product_ids:
+        if product_id in index.positions:
+            index.replace(product_id, rows.get(product_id))
+        elif product_id in rows and rows[product_id]['is_active']:
+            added.append(rows[product_id])
+    for product in sorted(added, key=FacetIndex._order):
+        if not index.append(product):
+            rebuild_facet_index_in_background()
+            break
+
+# Featured products ranking
+FEATURED_DISPLAY_COUNT = 6  # products shown on the home page
+FEATURED_POOL_SIZE = 24  # ranked products kept so drop-outs can be replaced without a full scan
+FEATURED_SALES_WINDOW_DAYS = 30
+
+FEATURED_VIEW_WEIGHT = 0.25  # one sale is worth roughly four views in log space
+
+FEATURED_CANDIDATES_QUERY = f'''
+    SELECT p.id, p.average_rating, p.total_reviews, p.created_at,
+           COALESCE(s.units, 0) as recent_units,
+           COALESCE(v.views, 0) as recent_views
+    FROM products p
+    LEFT JOIN (
+        SELECT oi.product_id, SUM(oi.quantity) as units
+        FROM order_items oi
+        JOIN orders o ON oi.order_id = o.id
+        WHERE o.status != 'cancelled'
+          AND o.created_at >= datetime('now', '-{FEATURED_SALES_WINDOW_DAYS} days')
+        GROUP BY oi.product_id
+    ) s ON s.product_id = p.id
+    LEFT JOIN (
+        SELECT product_id, SUM(views) as views
+        FROM product_view_days
+        WHERE day >= date('now', '-{FEATURED_SALES_WINDOW_DAYS} days')
+        GROUP BY product_id
+    ) v ON v.product_id = p.id
+    WHERE p.is_active = 1
+'''
+
+def featured_score(candidate):
+    """Rating shrunk towards zero for few reviews, plus log-damped recent sales and views"""
+    reviews = candidate['total_reviews'] or 0
+    rating = (candidate['average_rating'] or 0) * reviews / (reviews + 3)
+    return (rating + math.log1p(candidate['recent_units'])
+            + FEATURED_VIEW_WEIGHT * math.log1p(candidate['recent_views']))
+
+def save_featured_products(conn, ranked):
+    conn.execute('DELETE FROM featured_products')
+    conn.executemany('''
+        INSERT INTO featured_products (rank, product_id, score, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', [(rank, product_id, score, created_at)
+          for rank, (score, created_at, product_id) in enumerate(ranked, start=1)])
+
+def rank_featured(entries):
+    # Highest score first, newest product first on ties
+    return sorted(entries, key=lambda e: (e[0], e[1] or ''), reverse=True)[:FEATURED_POOL_SIZE]
+
+def refresh_featured_products():
+    """Recompute the whole featured ranking (scheduled, or when the pool runs low)"""
+    conn = get_db_connection()
+    candidates = conn.execute(FEATURED_CANDIDATES_QUERY).fetchall()
+    ranked = rank_featured([(featured_score(c), c['created_at'], c['id']) for c in candidates])
+    save_featured_products(conn, ranked)
+    conn.commit()
+    conn.close()
+    bump_catalog_version()
+    publish_catalog_change('listing')
+    return len(ranked)
+
+def update_featured_products(product_ids):
+    """Re-score a few products after a rating or sales change and merge them into the ranking"""
+    product_ids = {int(product_id) for product_id in product_ids}
+    if not product_ids:
+        return
+    
+    conn = get_db_connection()
+    current = [(row['score'], row['created_at'], row['product_id'])
+               for row in conn.execute('SELECT * FROM featured_products ORDER BY rank').fetchall()]
+    pool_was_full = len(current) >= FEATURED_POOL_SIZE
+    placeholders = ','.join('?' * len(product_ids))
+    candidates = conn.execute(FEATURED_CANDIDATES_QUERY + f' AND p.id IN ({placeholders})',
+                              list(product_ids)).fetchall()
+    
+    entries = [entry for entry in current if entry[2] not in product_ids]
+    entries += [(featured_score(c), c['created_at'], c['id']) for c in candidates]
+    ranked = rank_featured(entries)
+    
+    if pool_was_full and len(ranked) < FEATURED_POOL_SIZE:
+        # A product left a full pool; the next best one is unknown without a scan
+        conn.close()
+        refresh_featured_products()
+        return
+    
+    if ranked != current:
+        save_featured_products(conn, ranked)
+        conn.commit()
+    conn.close()
+
+# Product view counting
+VIEW_FLUSH_INTERVAL = 5  # seconds between batched writes of buffered views
+
+class ViewCounter:
+    """Buffers product views in memory and adds them to product_view_days in batches.
+
+    Each worker process keeps its own deltas and flushes them as increments,
+    so several processes can count the same product without losing views.
+    """
+
+    def __init__(self, interval=VIEW_FLUSH_INTERVAL):
+        self.interval = interval
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def record(self, product_id):
+        with self._lock:
+            self._deltas[product_id] = self._deltas.get(product_id, 0) + 1
+            if self._flusher_pid != os.getpid():
+                # First view in this process (or after a fork): start its flusher
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._run, name='view-counter', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Write all buffered views in one transaction"""
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return 0
+        
+        try:
+            conn = get_db_connection()
+            with conn:
+                conn.executemany('''
+                    INSERT INTO product_view_days (product_id, day, views)
+                    VALUES (?, date('now'), ?)
+                    ON CONFLICT (product_id, day) DO UPDATE SET views = views + excluded.views
+                ''', list(deltas.items()))
+            conn.close()
+        except sqlite3.Error as e:
+            # Keep the views for the next attempt
+            print(f"Error flushing product views: {e}")
+            with self._lock:
+                for product_id, views in deltas.items():
+                    self._deltas[product_id] = self._deltas.get(product_id, 0) + views
+            return 0
+        return len(deltas)
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
+
+# Recently viewed products
+RECENTLY_VIEWED_SIZE = 12  # products kept per user
+RECENTLY_VIEWED_SAVE_INTERVAL = 60  # seconds between writes for a logged-in user
+
+def push_recently_viewed(ring, product_id):
+    """Move product_id to the front of a bounded most-recent-first list"""
+    return ([product_id] + [p for p in ring if p != product_id])[:RECENTLY_VIEWED_SIZE]
+
+def save_recently_viewed(conn, user_id, ring):
+    conn.execute('''
+        INSERT INTO recently_viewed (user_id, product_ids, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            product_ids = excluded.product_ids, updated_at = excluded.updated_at
+    ''', (user_id, pack_product_ids(ring)))
+
+def record_recently_viewed(product_id):
+    """Keep the ring in the session; logged-in users get it persisted at most once per interval"""
+    ring = push_recently_viewed(session.get('recently_viewed', []), product_id)
+    session['recently_viewed'] = ring
+    
+    if 'user_id' in session:
+        now = time.time()
+        if now - session.get('recently_viewed_saved_at', 0) >= RECENTLY_VIEWED_SAVE_INTERVAL:
+            conn = get_db_connection()
+            save_recently_viewed(conn, session['user_id'], ring)
+            conn.commit()
+            conn.close()
+            session['recently_viewed_saved_at'] = now
+        else:
+            session['recently_viewed_dirty'] = True
+
+def load_recently_viewed(conn, user_id):
+    """Merge the stored ring into the session's one at login"""
+    row = conn.execute('SELECT product_ids FROM recently_viewed WHERE user_id = ?', (user_id,)).fetchone()
+    ring = list(session.get('recently_viewed', []))
+    for product_id in unpack_product_ids(row['product_ids']) if row else []:
+        if product_id not in ring:
+            ring.append(product_id)
+    session['recently_viewed'] = ring[:RECENTLY_VIEWED_SIZE]
+
+def counts_product_view(f):
+    """Count a product page view, including views served from the page cache.
+
+    Only rendered pages count, so ids that redirect as not found never reach
+    product_view_days or the recently viewed ring.
+    """
+    def wrapper(*args, **kwargs):
+        response = app.make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            view_counter.record(kwargs['product_id'])
+            record_recently_viewed(kwargs['product_id'])
+        return response
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+# Abandoned cart expiry
+CART_TTL_DAYS = 30  # cart lines untouched this long are dropped
+CART_CLEANUP_BATCH = 500  # lines deleted per short write transaction
+CART_IDLE_DAYS = 7  # lines untouched this long count as abandoned in analytics
+
+def expire_abandoned_carts(ttl_days=CART_TTL_DAYS, batch_size=CART_CLEANUP_BATCH):
+    """Delete stale cart lines in small batches and tally them per day.
+
+    Each batch is its own transaction, so the writer lock is only held for
+    a few milliseconds at a time and shoppers keep writing in between.
+    """
+    conn = get_db_connection()
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f'-{ttl_days} days',)).fetchone()[0]
+    expired = 0
+    while True:
+        selected = conn.execute('''
+            SELECT c.id, COALESCE(p.price, 0) as price
+            FROM cart c
+            LEFT JOIN products p ON c.product_id = p.id
+            WHERE c.updated_at < ?
+            ORDER BY c.updated_at
+            LIMIT ?
+        ''', (cutoff, batch_size)).fetchall()
+        if not selected:
+            break
+        
+        # Re-check the age: a shopper may have touched a line since the SELECT
+        prices = {line['id']: line['price'] for line in selected}
+        lines = conn.execute(f'''
+            DELETE FROM cart WHERE id IN ({','.join('?' * len(prices))}) AND updated_at < ?
+            RETURNING id, quantity
+        ''', [*prices, cutoff]).fetchall()
+        conn.execute('''
+            INSERT INTO abandoned_cart_days (day, lines, quantity, value)
+            VALUES (date('now'), ?, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                lines = lines + excluded.lines,
+                quantity = quantity + excluded.quantity,
+                value = value + excluded.value
+        ''', (len(lines),
+              sum(line['quantity'] for line in lines),
+              round(sum(line['quantity'] * prices[line['id']] for line in lines), 2)))
+        conn.commit()
+        expired += len(lines)
+        if len(selected) < batch_size:
+            break
+    conn.close()
+    return expired
 
 # Currency configuration - Store prices in INR directly
 # Shipping and tax configuration
 FREE_SHIPPING_THRESHOLD = 2000  # INR
 SHIPPING_CHARGE = 99  # INR
-GST_RATE = 0.18  # 18% GST
+GST_RATE = 0.18  # 18% GST, for categories without their own slab
+GST_SLABS = (0, 0.05, 0.12, 0.18, 0.28)  # rates a category can be assigned
+
+class PricingRules:
+    """Shipping and per-category GST compiled into flat lookup tables.
+
+    ``gst_rates`` is a list indexed by category id, so taxing a line is a
+    single lookup. ``quote_many`` prices any number of carts from parallel
+    line columns in one pass; ``quote`` is the single-cart case.
+    """
+
+    def __init__(self, category_rates, default_rate=GST_RATE,
+                 shipping_charge=SHIPPING_CHARGE, free_shipping_threshold=FREE_SHIPPING_THRESHOLD):
+        self.default_rate = default_rate
+        self.shipping_charge = shipping_charge
+        self.free_shipping_threshold = free_shipping_threshold
+        self.gst_rates = [default_rate] * (max(category_rates, default=0) + 1)
+        for category_id, rate in category_rates.items():
+            if rate is not None:
+                self.gst_rates[category_id] = rate
+
+    def gst_rate(self, category_id):
+        if category_id is None or not 0 <= category_id < len(self.gst_rates):
+            return self.default_rate
+        return self.gst_rates[category_id]
+
+    def quote_many(self, cart_indexes, category_ids, amounts, cart_count):
+        """Totals for cart_count carts; line i of amount amounts[i] belongs to cart cart_indexes[i]"""
+        subtotals = [0] * cart_count
+        taxes = [0] * cart_count
+        gst_rate = self.gst_rate
+        for cart_index, category_id, amount in zip(cart_indexes, category_ids, amounts):
+            subtotals[cart_index] += amount
+            taxes[cart_index] += amount * gst_rate(category_id)
+        return [self.totals(subtotal, gst) for subtotal, gst in zip(subtotals, taxes)]
+
+    def quote(self, lines):
+        """Totals for one cart given (category_id, amount) lines"""
+        lines = list(lines)
+        return self.quote_many([0] * len(lines), [line[0] for line in lines],
+                               [line[1] for line in lines], 1)[0]
+
+    def totals(self, subtotal, gst):
+        shipping = 0 if subtotal >= self.free_shipping_threshold else self.shipping_charge
+        return {
+            'subtotal': subtotal,
+            'shipping': shipping,
+            'gst': gst,
+            'total': subtotal + shipping + gst,
+            'free_shipping_threshold': self.free_shipping_threshold
+        }
+
+def get_pricing_rules():
+    """Rules compiled from the category table, rebuilt after any category write"""
+    return cached_fragment(
+        ('pricing', category_version),
+        lambda: PricingRules({row['id']: row['gst_rate'] for row in get_categories()}))
+
+def quote_cart(items, coupon_code=None):
+    """Totals for cart rows carrying product_id, category_id and subtotal.
+
+    The best applicable promotion is taken off the lines it covers before
+    GST is worked out. Used by cart, checkout, place_order and cart writes.
+    """
+    lines = [(item['product_id'], item['category_id'], item['subtotal']) for item in items]
+    promotion, discount, line_discounts = get_promotion_index().best_offer(lines, coupon_code)
+    totals = get_pricing_rules().quote(
+        (category_id, amount - line_discount)
+        for (_, category_id, amount), line_discount in zip(lines, line_discounts))
+    totals['subtotal'] = sum(amount for _, _, amount in lines)
+    totals['discount'] = discount
+    totals['promotion'] = promotion
+    return totals
+
+# Promotions
+promotions_version = 0
+
+class PromotionIndex:
+    """Live promotions keyed by the product, category or cart they cover.
+
+    Evaluating a cart looks up each line's product and category once, so
+    the cost follows the number of lines rather than the number of
+    promotions. Promotions without a code apply automatically; coupons
+    only once their code is entered. The best single offer wins.
+    """
+
+    def __init__(self, promotions):
+        self.by_code = {}
+        self.by_product = {}
+        self.by_category = {}
+        self.cart_wide = []
+        for promotion in promotions:
+            promotion = dict(promotion)
+            if promotion['code']:
+                self.by_code[promotion['code']] = promotion
+            if promotion['scope'] == 'product':
+                self.by_product.setdefault(promotion['scope_id'], []).append(promotion)
+            elif promotion['scope'] == 'category':
+                self.by_category.setdefault(promotion['scope_id'], []).append(promotion)
+            else:
+                self.cart_wide.append(promotion)
+
+    @staticmethod
+    def is_live(promotion, code, now):
+        return ((promotion['code'] is None or promotion['code'] == code)
+                and (promotion['starts_at'] is None or promotion['starts_at'] <= now)
+                and (promotion['ends_at'] is None or now < promotion['ends_at']))
+
+    def best_offer(self, lines, code=None):
+        """Best discount for (product_id, category_id, amount) lines.
+
+        Returns (promotion, discount, line_discounts), with the discount
+        spread over the lines it was earned on.
+        """
+        code = normalize_coupon_code(code)
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        covered = {}  # promotion id -> (promotion, indexes of the lines it covers)
+        for index, (product_id, category_id, _) in enumerate(lines):
+            for promotion in self.by_product.get(product_id, []) + self.by_category.get(category_id, []):
+                if self.is_live(promotion, code, now):
+                    covered.setdefault(promotion['id'], (promotion, []))[1].append(index)
+        for promotion in self.cart_wide:
+            if lines and self.is_live(promotion, code, now):
+                covered[promotion['id']] = (promotion, range(len(lines)))
+        
+        subtotal = sum(amount for _, _, amount in lines)
+        best = (None, 0, [0] * len(lines))
+        for promotion, indexes in covered.values():
+            if subtotal < (promotion['min_cart_amount'] or 0):
+                continue
+            base = sum(lines[index][2] for index in indexes)
+            if promotion['kind'] == 'percent':
+                discount = base * promotion['value'] / 100
+            else:
+                discount = min(promotion['value'], base)
+            discount = round(discount, 2)
+            if discount > best[1]:
+                line_discounts = [0] * len(lines)
+                for index in indexes:
+                    line_discounts[index] = discount * lines[index][2] / base
+                best = (promotion, discount, line_discounts)
+        return best
+
+def normalize_coupon_code(code):
+    return code.strip().upper() if code else None
+
+def get_promotion_index():
+    """Active, not yet exhausted promotions, recompiled after promotion writes and redemptions"""
+    return cached_fragment(('promotions', promotions_version), lambda: PromotionIndex(query_all('''
+        SELECT * FROM promotions
+        WHERE is_active = 1 AND (max_redemptions IS NULL OR redemptions < max_redemptions)
+    ''')))
+
+def invalidate_promotions(publish=True):
+    global promotions_version
+    promotions_version += 1
+    personal_state_cache.clear()
+    if publish:
+        publish_catalog_change('promotions')
+
+def redeem_promotion(conn, promotion):
+    """Claim one use of a promotion inside the order transaction; False once the limit is reached"""
+    claimed = conn.execute('''
+        UPDATE promotions SET redemptions = redemptions + 1
+        WHERE id = ? AND is_active = 1
+          AND (max_redemptions IS NULL OR redemptions < max_redemptions)
+    ''', (promotion['id'],)).rowcount == 1
+    if not claimed or promotion['max_redemptions'] is not None:
+        invalidate_promotions()
+    return claimed
+
+def quote_open_carts(conn, rules):
+    """Re-quote every open cart in one query and one batch pass: {user_id: totals}"""
+    user_ids = []
+    cart_indexes, category_ids, amounts = [], [], []
+    for row in conn.execute('''
+        SELECT c.user_id, p.category_id, c.quantity * p.price as amount
+        FROM cart c
+        JOIN products p ON c.product_id = p.id
+        WHERE p.is_active = 1
+        ORDER BY c.user_id
+    '''):
+        if not user_ids or user_ids[-1] != row['user_id']:
+            user_ids.append(row['user_id'])
+        cart_indexes.append(len(user_ids) - 1)
+        category_ids.append(row['category_id'])
+        amounts.append(row['amount'])
+    return dict(zip(user_ids, rules.quote_many(cart_indexes, category_ids, amounts, len(user_ids))))
+
+# Order status workflow
+ORDER_TRANSITIONS = {
+    'pending': ('processing', 'cancelled'),
+    'processing': ('shipped',),
+    'shipped': ('delivered',),
+    'delivered': (),
+    'cancelled': (),
+}
+ORDER_STATUSES = tuple(ORDER_TRANSITIONS)
+ORDER_DELIVERY_DAYS = 7  # estimate given when the order is placed
+ORDER_TRANSIT_DAYS = 3  # estimate once the parcel has shipped
+ORDER_BULK_BATCH = 200  # orders moved per transaction by a bulk status update
+ORDER_BULK_LIMIT = 5000  # orders one bulk request may touch
+
+@app.template_global()
+def next_order_statuses(status):
+    return ORDER_TRANSITIONS.get(status, ())
+
+def record_order_events(conn, events):
+    """Append status events and move their orders between the status counters, in the caller's transaction.
+
+    events are (order_id, from_status, to_status, amount, note, actor_id)
+    tuples; the counters get one write per status however many orders moved.
+    """
+    conn.executemany('''
+        INSERT INTO order_events (order_id, from_status, to_status, note, actor_id)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(order_id, from_status, to_status, note, actor_id)
+          for order_id, from_status, to_status, amount, note, actor_id in events])
+    counter_moves = defaultdict(lambda: [0, 0])
+    for order_id, from_status, to_status, amount, note, actor_id in events:
+        counter_moves[to_status][0] += 1
+        counter_moves[to_status][1] += amount or 0
+        if from_status:
+            counter_moves[from_status][0] -= 1
+            counter_moves[from_status][1] -= amount or 0
+    conn.executemany('''
+        INSERT INTO order_status_counts (status, orders, revenue) VALUES (?, ?, ?)
+        ON CONFLICT(status) DO UPDATE SET
+            orders = orders + excluded.orders,
+            revenue = revenue + excluded.revenue
+    ''', [(status, orders, revenue) for status, (orders, revenue) in counter_moves.items()])
+
+def transition_orders(conn, order_ids, new_status, note=None, actor_id=None):
+    """Move orders one step along ORDER_TRANSITIONS with set-based statements, without committing.
+
+    Each UPDATE is guarded on a status the move is allowed from, so orders
+    that are not eligible, or changed under a concurrent request, are left
+    out rather than failing the batch. Cancelled orders get their stock
+    back. Returns {order_id: previous status} for the orders that moved.
+    """
+    sources = [status for status, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    if not order_ids or not sources:
+        return {}
+    placeholders = ','.join('?' * len(order_ids))
+    moved = {}
+    events = []
+    for source in sources:
+        for row in conn.execute(f'''
+            UPDATE orders SET status = ?,
+                notes = CASE WHEN ? = 'cancelled' THEN COALESCE(?, notes) ELSE notes END,
+                estimated_delivery = CASE ?
+                    WHEN 'shipped' THEN datetime('now', ?)
+                    WHEN 'cancelled' THEN NULL
+                    ELSE estimated_delivery END,
+                delivered_at = CASE WHEN ? = 'delivered' THEN CURRENT_TIMESTAMP ELSE delivered_at END
+            WHERE status = ? AND id IN ({placeholders})
+            RETURNING id, total_amount
+        ''', [new_status, new_status, note, new_status, f'+{ORDER_TRANSIT_DAYS} days', new_status,
+              source, *order_ids]).fetchall():
+            moved[row['id']] = source
+            events.append((row['id'], source, new_status, row['total_amount'], note, actor_id))
+    if not moved:
+        return moved
+
+    if new_status == 'cancelled':
+        moved_placeholders = ','.join('?' * len(moved))
+        conn.execute(f'''
+            UPDATE products SET stock_quantity = stock_quantity + (
+                SELECT SUM(oi.quantity) FROM order_items oi
+                WHERE oi.order_id IN ({moved_placeholders}) AND oi.product_id = products.id
+            )
+            WHERE id IN (SELECT product_id FROM order_items WHERE order_id IN ({moved_placeholders}))
+        ''', [*moved, *moved])
+    record_order_events(conn, events)
+    return moved
+
+def transition_order(conn, order_id, new_status, note=None, actor_id=None):
+    """Single-order transition_orders(): the previous status, or None when the move was refused"""
+    return transition_orders(conn, [order_id], new_status, note, actor_id).get(order_id)
+
+def order_product_ids(conn, order_ids):
+    if not order_ids:
+        return []
+    placeholders = ','.join('?' * len(order_ids))
+    return [row['product_id'] for row in conn.execute(f'''
+        SELECT DISTINCT product_id FROM order_items WHERE order_id IN ({placeholders})
+    ''', list(order_ids)).fetchall()]
+
+def rebuild_order_status_counts(conn):
+    conn.execute('DELETE FROM order_status_counts')
+    conn.execute('''
+        INSERT INTO order_status_counts (status, orders, revenue)
+        SELECT status, COUNT(*), COALESCE(SUM(total_amount), 0) FROM orders GROUP BY status
+    ''')
+
+def get_order_status_counts(conn):
+    """Order count and revenue per status from the event-maintained counters, plus totals"""
+    counts = {status: {'orders': 0, 'revenue': 0} for status in ORDER_STATUSES}
+    for row in conn.execute('SELECT status, orders, revenue FROM order_status_counts'):
+        counts[row['status']] = {'orders': row['orders'], 'revenue': row['revenue']}
+    stats = {f'{status}_orders': count['orders'] for status, count in counts.items()}
+    stats['total_orders'] = sum(count['orders'] for count in counts.values())
+    stats['total_revenue'] = sum(count['revenue'] for count in counts.values())
+    stats['by_status'] = [{'status': status, 'count': count['orders']}
+                          for status, count in counts.items() if count['orders']]
+    return stats
+
+def get_order_timelines(conn, order_ids):
+    """Status events for several orders in one query: {order_id: [event, ...]} oldest first"""
+    timelines = {order_id: [] for order_id in order_ids}
+    if not order_ids:
+        return timelines
+    placeholders = ','.join('?' * len(order_ids))
+    for event in conn.execute(f'''
+        SELECT e.order_id, e.from_status, e.to_status, e.note, e.created_at, u.full_name as actor_name
+        FROM order_events e
+        LEFT JOIN users u ON e.actor_id = u.id
+        WHERE e.order_id IN ({placeholders})
+        ORDER BY e.order_id, e.id
+    ''', list(order_ids)):
+        timelines[event['order_id']].append(event)
+    return timelines
 
 # Indian States
 INDIAN_STATES = [
@@ -107,14 +1229,388 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+# Page cache configuration
+PAGE_CACHE_SIZE = 256  # rendered pages kept in memory
+PAGE_CACHE_TTL = 300  # seconds
+FRAGMENT_CACHE_SIZE = 2048  # product, review and related-product blocks
+PERSONAL_STATE_CACHE_SIZE = 1024  # users whose cart/wishlist ids are kept
+PERSONAL_STATE_TTL = 30  # seconds
+
+class LRUCache:
+    """Small thread-safe LRU cache with optional per-entry expiry"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def evict(self, predicate):
+        """Drop every entry whose value matches predicate"""
+        with self._lock:
+            for key in [key for key, (value, _) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+page_cache = LRUCache(PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+personal_state_cache = LRUCache(PERSONAL_STATE_CACHE_SIZE, ttl=PERSONAL_STATE_TTL)
+catalog_version = 0
+category_version = 0
+fragment_versions = {}  # ('product' | 'reviews' | 'category', id) -> version
+product_categories = {}  # product id -> category id, learned from cached product blocks
+
+def bump_catalog_version():
+    """Invalidate cached listing pages after a product, category, review or stock write"""
+    global catalog_version
+    catalog_version += 1
+
+def fragment_version(kind, key):
+    return fragment_versions.get((kind, key), 0)
+
+def bump_fragment_version(kind, key):
+    fragment_versions[(kind, key)] = fragment_version(kind, key) + 1
+
+# The invalidate_* helpers also log the change for other processes unless publish=False,
+# which is how apply_catalog_changes repeats another process's change here.
+def invalidate_product(product_id, *category_ids, publish=True):
+    """A product row changed: evict its block and the related lists of its categories"""
+    product_id = int(product_id)
+    # Cart subtotals depend on price and is_active; a product switched back on
+    # shows up in carts once their PERSONAL_STATE_TTL runs out
+    personal_state_cache.evict(lambda state: product_id in state['cart_product_ids'])
+    bump_fragment_version('product', product_id)
+    for category_id in {product_categories.get(product_id), *category_ids}:
+        if category_id:
+            bump_fragment_version('category', int(category_id))
+    bump_catalog_version()
+    if publish:
+        publish_catalog_change('product', product_id)
+
+def invalidate_reviews(product_id, publish=True):
+    """Reviews changed for one product; other products keep their cached blocks"""
+    bump_fragment_version('reviews', product_id)
+    bump_fragment_version('product', product_id)
+    bump_catalog_version()
+    if publish:
+        publish_catalog_change('reviews', product_id)
+
+def invalidate_recommendations(product_id=None, publish=True):
+    """Related products changed for one product, or for every product after a rebuild"""
+    if product_id is None:
+        fragment_cache.clear()
+        page_cache.clear()
+    else:
+        bump_fragment_version('recommendations', product_id)
+    if publish:
+        publish_catalog_change('recommendations', product_id)
+
+def invalidate_categories(publish=True):
+    """Category names appear in every product block and in the nav, so drop everything"""
+    global category_version
+    category_version += 1
+    bump_catalog_version()
+    index_categories_for_search()
+    if publish:
+        publish_catalog_change('categories')
+
+# Cross-process cache invalidation
+# The versions above only invalidate this process. Every invalidation is also logged
+# to catalog_changes as (kind, key); other processes poll the log and repeat the same
+# targeted invalidation, so they serve stale pages for at most CATALOG_CHANGES_POLL seconds.
+CATALOG_CHANGES_POLL = 2  # seconds between reads of catalog_changes
+CATALOG_CHANGES_KEEP = 10000  # log rows kept; a process further behind than this drops everything
+catalog_changes_seen = 0  # id of the last logged change this process has applied
+catalog_changes_checked_at = 0
+catalog_changes_lock = threading.Lock()
+catalog_origin = secrets.token_hex(4)  # marks this process's own log rows
+
+def new_catalog_origin():
+    global catalog_origin
+    catalog_origin = secrets.token_hex(4)
+
+if hasattr(os, 'register_at_fork'):
+    # Forked server workers must not skip each other's changes as their own
+    os.register_at_fork(after_in_child=new_catalog_origin)
+
+def publish_catalog_change(kind, key=None):
+    """Log a change for other processes, once per request after the request's own writes"""
+    if has_request_context():
+        g.setdefault('catalog_changes', set()).add((kind, key))
+    else:
+        store_catalog_changes({(kind, key)})
+
+def store_catalog_changes(changes):
+    conn = get_db_connection()
+    conn.executemany('INSERT INTO catalog_changes (kind, key, origin) VALUES (?, ?, ?)',
+                     [(kind, key, catalog_origin) for kind, key in changes])
+    conn.execute('DELETE FROM catalog_changes WHERE id <= (SELECT MAX(id) FROM catalog_changes) - ?',
+                 (CATALOG_CHANGES_KEEP,))
+    conn.commit()
+    conn.close()
+
+@app.teardown_request
+def publish_request_catalog_changes(exc):
+    changes = g.pop('catalog_changes', None)
+    if changes:
+        store_catalog_changes(changes)
+
+def load_catalog_changes_position(conn):
+    """Start from the end of the log; called by init_db, before anything is cached"""
+    global catalog_changes_seen, catalog_changes_checked_at
+    catalog_changes_seen = conn.execute('SELECT COALESCE(MAX(id), 0) FROM catalog_changes').fetchone()[0]
+    catalog_changes_checked_at = time.time()
+
+def reset_local_caches():
+    """This process fell behind the change log: forget everything cached from the catalog"""
+    global catalog_version, category_version, promotions_version
+    catalog_version += 1
+    category_version += 1
+    promotions_version += 1
+    rebuild_search_index_in_background()
+    rebuild_facet_index_in_background()
+    page_cache.clear()
+    fragment_cache.clear()
+    personal_state_cache.clear()
+
+def apply_catalog_changes(changes):
+    """Repeat other processes' invalidations here, evicting only what they touched"""
+    if ('catalog', None) in changes:
+        reset_local_caches()
+        return
+    
+    product_ids = set()
+    for kind, key in changes:
+        if kind == 'product':
+            product_ids.add(key)
+        elif kind == 'reviews':
+            invalidate_reviews(key, publish=False)
+            product_ids.add(key)  # ratings feed the search weight and rating facets
+        elif kind == 'recommendations':
+            invalidate_recommendations(key, publish=False)
+        elif kind == 'categories':
+            invalidate_categories(publish=False)
+        elif kind == 'promotions':
+            invalidate_promotions(publish=False)
+        elif kind == 'listing':
+            bump_catalog_version()
+    if not product_ids:
+        return
+    
+    changed_products = [key for kind, key in changes if kind == 'product']
+    if changed_products:
+        category_ids = dict(query_all(f'''
+            SELECT id, category_id FROM products WHERE id IN ({','.join('?' * len(changed_products))})
+        ''', changed_products))
+        for product_id in changed_products:
+            invalidate_product(product_id, category_ids.get(product_id), publish=False)
+    reindex_products_for_search(product_ids)
+    refresh_facets(product_ids)
+
+@app.before_request
+def sync_catalog_changes():
+    global catalog_changes_seen, catalog_changes_checked_at
+    if time.time() - catalog_changes_checked_at < CATALOG_CHANGES_POLL:
+        return
+    with catalog_changes_lock:
+        if time.time() - catalog_changes_checked_at < CATALOG_CHANGES_POLL:
+            return
+        conn = get_db_connection()
+        oldest = conn.execute('SELECT MIN(id) FROM catalog_changes').fetchone()[0]
+        rows = conn.execute('''
+            SELECT id, kind, key, origin FROM catalog_changes WHERE id > ? ORDER BY id
+        ''', (catalog_changes_seen,)).fetchall()
+        conn.close()
+        catalog_changes_checked_at = time.time()
+        if not rows:
+            return
+        missed = oldest > catalog_changes_seen + 1  # pruned before this process read them
+        catalog_changes_seen = rows[-1]['id']
+    
+    if missed:
+        apply_catalog_changes({('catalog', None)})
+    else:
+        apply_catalog_changes({(row['kind'], row['key']) for row in rows if row['origin'] != catalog_origin})
+
+def get_categories():
+    """All categories ordered by name, re-read only after a category write"""
+    return cached_fragment(
+        ('categories', category_version),
+        lambda: query_all('SELECT * FROM categories ORDER BY name'))
+
+def query_all(query, params=()):
+    conn = get_db_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return rows
+
+def cached_fragment(key, loader):
+    value = fragment_cache.get(key)
+    if value is None:
+        value = loader()
+        if value is not None:
+            fragment_cache.set(key, value)
+    return value
+
+def listing_page_version(**view_args):
+    return catalog_version
+
+def product_page_version(product_id):
+    return (fragment_version('product', product_id),
+            fragment_version('reviews', product_id),
+            fragment_version('recommendations', product_id),
+            fragment_version('category', product_categories.get(product_id)),
+            category_version)
+
+def page_audience():
+    """Cached pages vary only by who is looking: guest (with or without a cart), customer or admin"""
+    if 'user_id' not in session:
+        return 'guest_cart' if session.get('guest_cart') else 'guest'
+    return 'admin' if session.get('role') == 'admin' else 'user'
+
+def cached_page(version=listing_page_version):
+    """Serve catalog pages from the page cache.
+
+    Pages are keyed by URL, the version returned by ``version(**view_args)``
+    and audience. User specific bits (username, cart counter, wishlist hearts)
+    are left blank in the shell and filled in by main.js from /session_state.
+    """
+    return lambda f: _cached_page_view(f, version)
+
+def _cached_page_view(f, version):
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return f(*args, **kwargs)
+        
+        key = (request.full_path, version(**kwargs), page_audience())
+        html = page_cache.get(key)
+        if html is not None:
+            response = app.make_response(html)
+            response.headers['X-Page-Cache'] = 'HIT'
+            return response
+        
+        g.page_cache_shell = True
+        result = f(*args, **kwargs)
+        response = app.make_response(result)
+        if isinstance(result, str) and response.status_code == 200 and not session.get('_flashes'):
+            page_cache.set(key, result)
+            response.headers['X-Page-Cache'] = 'MISS'
+        return response
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+def summarize_cart(lines):
+    """Header counter figures from (product_id, quantity, price) cart lines"""
+    return {
+        'cart_count': sum(quantity for _, quantity, _ in lines),
+        'cart_lines': len(lines),
+        'cart_subtotal': round(sum(quantity * price for _, quantity, price in lines), 2),
+        'cart_product_ids': frozenset(product_id for product_id, _, _ in lines)
+    }
+
+def load_personal_state(user_id):
+    """Cart summary plus cart and wishlist product ids for one user, in two queries"""
+    conn = get_db_connection()
+    cart_rows = conn.execute('''
+        SELECT c.product_id, c.quantity, p.price
+        FROM cart c
+        JOIN products p ON c.product_id = p.id
+        WHERE c.user_id = ? AND p.is_active = 1
+    ''', (user_id,)).fetchall()
+    wishlist_rows = conn.execute(
+        'SELECT product_id FROM wishlist WHERE user_id = ?', (user_id,)
+    ).fetchall()
+    conn.close()
+    
+    state = summarize_cart([tuple(row) for row in cart_rows])
+    state['wishlist_product_ids'] = frozenset(row['product_id'] for row in wishlist_rows)
+    return state
+
+def load_guest_personal_state():
+    """Same shape for a guest; prices come from one query over the session cart"""
+    guest_cart = get_guest_cart()
+    lines = []
+    if guest_cart:
+        prices = dict(query_all(f'''
+            SELECT id, price FROM products
+            WHERE id IN ({','.join('?' * len(guest_cart))}) AND is_active = 1
+        ''', [int(product_id) for product_id in guest_cart]))
+        lines = [(int(product_id), quantity, prices[int(product_id)])
+                 for product_id, quantity in guest_cart.items() if int(product_id) in prices]
+    state = summarize_cart(lines)
+    state['wishlist_product_ids'] = frozenset()
+    return state
+
+def get_personal_state():
+    """Per-request view of the current user's cart and wishlist membership"""
+    if 'personal_state' not in g:
+        user_id = session.get('user_id')
+        if user_id is None:
+            # Guest carts live in the cookie, so their contents are the cache key: an
+            # unchanged cart skips the price query, a cart write is simply a new key
+            guest_cart = get_guest_cart()
+            key = ('guest', frozenset(guest_cart.items()))
+            loader = load_guest_personal_state
+        else:
+            key = user_id
+            loader = lambda: load_personal_state(user_id)
+        state = personal_state_cache.get(key)
+        if state is None:
+            state = loader()
+            personal_state_cache.set(key, state)
+        g.personal_state = state
+    return g.personal_state
+
+def invalidate_personal_state(user_id=None):
+    """Cart or wishlist changed; the next lookup reloads from the database"""
+    personal_state_cache.pop(session.get('user_id') if user_id is None else user_id)
+    g.pop('personal_state', None)
+
+@app.template_global()
+def in_cart(product_id):
+    """Shared page-cache shells never carry per-user flags; main.js sets them there"""
+    return not g.get('page_cache_shell') and product_id in get_personal_state()['cart_product_ids']
+
+@app.template_global()
+def in_wishlist(product_id):
+    return not g.get('page_cache_shell') and product_id in get_personal_state()['wishlist_product_ids']
+
 @app.context_processor
 def inject_categories():
     """Make categories available to all templates"""
     try:
-        conn = get_db_connection()
-        categories = conn.execute('SELECT * FROM categories ORDER BY name').fetchall()
-        conn.close()
-        return dict(categories=categories)
+        return dict(categories=get_categories())
     except:
         return dict(categories=[])
 
@@ -136,7 +1632,21 @@ def init_db():
             postal_code TEXT,
             role TEXT DEFAULT 'user',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
+            is_active BOOLEAN DEFAULT 1,
+            auth_version INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Bumped whenever an admin changes a user, so cached session roles go stale
+    user_columns = {row['name'] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'auth_version' not in user_columns:
+        conn.execute('ALTER TABLE users ADD COLUMN auth_version INTEGER DEFAULT 0')
+    
+    # Deleted users, so every process can drop their sessions (ids are never reused)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deleted_users (
+            user_id INTEGER PRIMARY KEY,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
@@ -147,10 +1657,15 @@ def init_db():
             name TEXT UNIQUE NOT NULL,
             description TEXT,
             image_url TEXT,
+            gst_rate REAL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
+    # Per-category GST slab; NULL falls back to GST_RATE
+    if 'gst_rate' not in {row['name'] for row in conn.execute('PRAGMA table_info(categories)')}:
+        conn.execute('ALTER TABLE categories ADD COLUMN gst_rate REAL')
+    
     # Products table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS products (
@@ -181,11 +1696,48 @@ def init_db():
             product_id INTEGER,
             quantity INTEGER DEFAULT 1,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id),
             FOREIGN KEY (product_id) REFERENCES products (id)
         )
     ''')
     
+    # Cart lines expire CART_TTL_DAYS after they were last touched
+    if 'updated_at' not in {row['name'] for row in conn.execute('PRAGMA table_info(cart)')}:
+        conn.execute('ALTER TABLE cart ADD COLUMN updated_at TIMESTAMP')
+        conn.execute('UPDATE cart SET updated_at = created_at')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cart_updated ON cart (updated_at)')
+    
+    # Bumped with every cart write so clients can drop out-of-order responses
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cart_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Expired cart lines per day, for abandoned cart reporting
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS abandoned_cart_days (
+            day DATE PRIMARY KEY,
+            lines INTEGER NOT NULL DEFAULT 0,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            value DECIMAL(10,2) NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # One line per user and product; fold duplicates left by older code first
+    conn.execute('''
+        UPDATE cart SET quantity = (
+            SELECT SUM(c.quantity) FROM cart c
+            WHERE c.user_id = cart.user_id AND c.product_id = cart.product_id
+        )
+        WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id HAVING COUNT(*) > 1)
+    ''')
+    conn.execute('DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_product ON cart (user_id, product_id)')
+    
     # Orders table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS orders (
@@ -204,11 +1756,90 @@ def init_db():
             estimated_delivery TIMESTAMP,
             delivered_at TIMESTAMP,
             notes TEXT,
+            discount_amount REAL DEFAULT 0,
+            promotion_id INTEGER REFERENCES promotions (id),
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
     
+    # Discount columns for orders placed with a promotion
+    order_columns = {row['name'] for row in conn.execute('PRAGMA table_info(orders)')}
+    if 'discount_amount' not in order_columns:
+        conn.execute('ALTER TABLE orders ADD COLUMN discount_amount REAL DEFAULT 0')
+    if 'promotion_id' not in order_columns:
+        conn.execute('ALTER TABLE orders ADD COLUMN promotion_id INTEGER REFERENCES promotions (id)')
+
+    # Append-only order status history; rows are only ever inserted
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            note TEXT,
+            actor_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders (id),
+            FOREIGN KEY (actor_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events (order_id, id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS order_events_no_update BEFORE UPDATE ON order_events
+        BEGIN SELECT RAISE(ABORT, 'order_events is append-only'); END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS order_events_no_delete BEFORE DELETE ON order_events
+        BEGIN SELECT RAISE(ABORT, 'order_events is append-only'); END
+    ''')
+
+    # Orders placed before the history existed get their placement and current status
+    conn.execute('''
+        INSERT INTO order_events (order_id, from_status, to_status, note, created_at)
+        SELECT id, NULL, 'pending', NULL, created_at FROM orders
+        WHERE id NOT IN (SELECT order_id FROM order_events)
+    ''')
+    conn.execute('''
+        INSERT INTO order_events (order_id, from_status, to_status, note, created_at)
+        SELECT o.id, 'pending', o.status, 'Recorded before status history was kept',
+               COALESCE(o.delivered_at, o.created_at)
+        FROM orders o
+        WHERE o.status != 'pending'
+          AND NOT EXISTS (SELECT 1 FROM order_events e WHERE e.order_id = o.id AND e.from_status IS NOT NULL)
+    ''')
+
+    # Per-status order counters kept by record_order_events, so dashboards never scan orders;
+    # recounted once at startup in case orders were written outside the app
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_counts (
+            status TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    rebuild_order_status_counts(conn)
+
+    # Promotions: coupons (with a code) and automatic offers (without one)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS promotions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE,
+            description TEXT NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('percent', 'flat')),
+            value REAL NOT NULL,
+            scope TEXT NOT NULL DEFAULT 'cart' CHECK (scope IN ('cart', 'category', 'product')),
+            scope_id INTEGER,
+            min_cart_amount REAL DEFAULT 0,
+            max_redemptions INTEGER,
+            redemptions INTEGER NOT NULL DEFAULT 0,
+            starts_at TIMESTAMP,
+            ends_at TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
     # Order items table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS order_items (
@@ -248,6 +1879,74 @@ def init_db():
         )
     ''')
     
+    # Review paging indexes, one per sort order so each page is an index range scan
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product_created ON reviews (product_id, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product_rating ON reviews (product_id, rating, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product_rating_asc ON reviews (product_id, rating, created_at DESC, id DESC)')
+    
+    # Co-purchase pair counts and the top-K "frequently bought together" list per product
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS product_copurchases (
+            product_id INTEGER NOT NULL,
+            other_product_id INTEGER NOT NULL,
+            pair_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, other_product_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_copurchases_rank ON product_copurchases (product_id, pair_count DESC, other_product_id)')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS product_recommendations (
+            product_id INTEGER PRIMARY KEY,
+            neighbours TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Product views per day, written in batches by ViewCounter
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS product_view_days (
+            product_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, day)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_product_view_days_day ON product_view_days (day)')
+    
+    # Recently viewed products per user, packed most recent first
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS recently_viewed (
+            user_id INTEGER PRIMARY KEY,
+            product_ids TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Cache invalidations logged for the other server processes (see sync_catalog_changes)
+    conn.execute('DROP TABLE IF EXISTS cache_versions')  # replaced by catalog_changes
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key INTEGER,
+            origin TEXT NOT NULL
+        )
+    ''')
+    load_catalog_changes_position(conn)
+    
+    # Materialized home page ranking, rank 1 first
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS featured_products (
+            rank INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
     conn.commit()
     conn.close()
 
@@ -256,12 +1955,250 @@ def is_logged_in():
     return 'user_id' in session
 
 def is_admin():
-    if not is_logged_in():
-        return False
+    # The session role is re-checked against users by check_session_auth whenever it may be stale
+    return is_logged_in() and session.get('role') == 'admin'
+
+# Password hashing pool
+PASSWORD_HASH_QUEUE = 4  # hashes allowed to wait per worker before logins are turned away
+PASSWORD_HASH_WAIT = 5  # seconds a login waits for room in the queue
+password_hash_pool = None
+password_hash_slots = None
+password_hash_pool_lock = threading.Lock()
+password_hash_prefixes = {}  # configured method -> the prefix werkzeug stores for it
+
+def run_password_hash(fn, *args):
+    """Run a hash or a verification on the bounded pool; None when the queue stays full.
+
+    hashlib releases the GIL while hashing, so without a cap a burst of
+    logins would occupy every core and starve catalog requests.
+    """
+    global password_hash_pool, password_hash_slots
+    if password_hash_pool is None:
+        with password_hash_pool_lock:
+            if password_hash_pool is None:
+                workers = app.config['PASSWORD_HASH_WORKERS']
+                password_hash_slots = threading.BoundedSemaphore(workers * (1 + PASSWORD_HASH_QUEUE))
+                password_hash_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+    if not password_hash_slots.acquire(timeout=PASSWORD_HASH_WAIT):
+        return None
+    try:
+        return password_hash_pool.submit(fn, *args).result()
+    finally:
+        password_hash_slots.release()
+
+def hash_password(password):
+    return run_password_hash(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    return run_password_hash(check_password_hash, password_hash, password)
+
+def password_needs_rehash(password_hash):
+    """True when a stored hash was made with a different method or work factor than configured"""
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method not in password_hash_prefixes:
+        # werkzeug fills in defaults ('pbkdf2' -> 'pbkdf2:sha256:600000'), so compare what it writes
+        password_hash_prefixes[method] = generate_password_hash('', method).split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != password_hash_prefixes[method]
+
+# Rate limiting
+app.config['RATE_LIMITS'] = {
+    # endpoint: buckets per client IP and per user as (burst, requests per minute);
+    # 'methods' limits which requests count, 'arg' counts only requests carrying that query argument
+    'login': {'methods': ('POST',), 'ip': (20, 10), 'user': (5, 3)},
+    'register': {'methods': ('POST',), 'ip': (5, 2)},
+    'products': {'arg': 'search', 'ip': (30, 60)},
+    'search_suggestions': {'ip': (60, 240), 'user': (60, 240)},
+    'add_to_cart': {'ip': (30, 60), 'user': (20, 40)},
+}
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('MEDIPLANT_RATE_LIMIT_BACKEND', 'memory')  # or 'sqlite'
+app.config['RATE_LIMIT_DATABASE'] = os.environ.get('MEDIPLANT_RATE_LIMIT_DATABASE', 'ratelimit.db')
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds between evictions of idle buckets
+
+class TokenBuckets:
+    """Token buckets for one process: key -> (tokens, last update, time the bucket is full again).
+
+    A bucket that has refilled completely behaves exactly like a missing
+    one, so the periodic sweep drops those and memory tracks only clients
+    that were throttled or busy recently.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def take(self, key, burst, per_minute):
+        """Spend one token; returns seconds to wait, or 0 when the request may proceed"""
+        rate = per_minute / 60
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if now - self._swept_at > RATE_LIMIT_SWEEP_INTERVAL:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+                self._swept_at = now
+        return wait
+
+class SQLiteTokenBuckets:
+    """The same buckets in a small SQLite file shared by every worker process.
+
+    Each take() is one atomic UPSERT, so workers never race on a bucket.
+    The file is separate from the shop database and runs in WAL mode
+    without fsync: losing it only forgets who was throttled. Buckets idle
+    for an hour, long enough to refill at any configured rate, are swept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._swept_at = time.time()
+        conn = self._connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                allowed INTEGER NOT NULL
+            )
+        ''')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, burst, per_minute):
+        rate = per_minute / 60
+        now = time.time()
+        conn = self._connection()
+        tokens, allowed = conn.execute('''
+            INSERT INTO buckets (key, tokens, updated, allowed) VALUES (?, ? - 1, ?, 1)
+            ON CONFLICT(key) DO UPDATE SET
+                allowed = min(?, tokens + (excluded.updated - updated) * ?) >= 1,
+                tokens = min(?, tokens + (excluded.updated - updated) * ?)
+                         - (min(?, tokens + (excluded.updated - updated) * ?) >= 1),
+                updated = excluded.updated
+            RETURNING tokens, allowed
+        ''', (key, burst, now, burst, rate, burst, rate, burst, rate)).fetchone()
+        if now - self._swept_at > RATE_LIMIT_SWEEP_INTERVAL:
+            self._swept_at = now
+            conn.execute('DELETE FROM buckets WHERE updated < ?', (now - 3600,))
+        return 0 if allowed else (1 - tokens) / rate
+
+rate_limit_buckets = None
+
+def get_rate_limit_buckets():
+    global rate_limit_buckets
+    if rate_limit_buckets is None:
+        if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+            rate_limit_buckets = SQLiteTokenBuckets(app.config['RATE_LIMIT_DATABASE'])
+        else:
+            rate_limit_buckets = TokenBuckets()
+    return rate_limit_buckets
+
+@app.before_request
+def enforce_rate_limits():
+    """Shed over-limit clients before the view touches the database or the password hasher"""
+    limits = app.config['RATE_LIMITS'].get(request.endpoint)
+    if not limits or request.method not in limits.get('methods', (request.method,)):
+        return
+    if limits.get('arg') and not request.args.get(limits['arg']):
+        return
+    
+    clients = {'ip': request.remote_addr}
+    if request.endpoint == 'login':
+        # Per account being tried, which is what a credential-stuffing run hammers
+        clients['user'] = request.form.get('username', '').strip().lower() or None
+    else:
+        clients['user'] = session.get('user_id')
+    
+    buckets = get_rate_limit_buckets()
+    for scope in ('ip', 'user'):
+        if scope not in limits or clients[scope] is None:
+            continue
+        burst, per_minute = limits[scope]
+        wait = buckets.take(f'{request.endpoint}:{scope}:{clients[scope]}', burst, per_minute)
+        if wait:
+            message = 'Too many requests. Please slow down and try again shortly.'
+            if request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                response = jsonify({'success': False, 'message': message})
+            else:
+                response = Response(message, mimetype='text/plain')
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+
+# Session authorization cache
+AUTH_VERSION_REFRESH = 5  # seconds between re-reads of changed users, so other workers see revocations
+AUTH_BOOT_ID = secrets.token_hex(8)  # sessions from before a restart are re-checked once
+auth_versions = {}  # user id -> auth_version, for users an admin has ever changed
+auth_deleted_users = set()  # user ids from deleted_users, plus deletes made here since the last refresh
+auth_versions_loaded_at = 0
+auth_versions_lock = threading.Lock()
+
+def refresh_auth_versions():
+    global auth_versions, auth_deleted_users, auth_versions_loaded_at
+    if time.time() - auth_versions_loaded_at < AUTH_VERSION_REFRESH:
+        return
+    with auth_versions_lock:
+        if time.time() - auth_versions_loaded_at < AUTH_VERSION_REFRESH:
+            return
+        conn = get_db_connection()
+        auth_versions = {row['id']: row['auth_version'] for row in conn.execute(
+            'SELECT id, auth_version FROM users WHERE auth_version > 0')}
+        auth_deleted_users = {row['user_id'] for row in conn.execute('SELECT user_id FROM deleted_users')}
+        conn.close()
+        auth_versions_loaded_at = time.time()
+
+def bump_auth_version(conn, user_id, deleted=False):
+    """Invalidate the cached role of every session of this user; call in the transaction that changes them"""
+    if deleted:
+        conn.execute('INSERT OR IGNORE INTO deleted_users (user_id) VALUES (?)', (user_id,))
+        auth_deleted_users.add(user_id)
+        return
+    version = conn.execute('''
+        UPDATE users SET auth_version = auth_version + 1 WHERE id = ?
+        RETURNING auth_version
+    ''', (user_id,)).fetchone()
+    if version:
+        auth_versions[user_id] = version['auth_version']
+
+def remember_session_auth(user):
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['role'] = user['role']
+    session['auth_version'] = user['auth_version'] or 0
+    session['auth_boot'] = AUTH_BOOT_ID
+
+@app.before_request
+def check_session_auth():
+    """Trust the role cached in the signed session unless the user was changed since it was issued"""
+    user_id = session.get('user_id')
+    if user_id is None:
+        return
+    refresh_auth_versions()
+    if (session.get('auth_boot') == AUTH_BOOT_ID
+            and user_id not in auth_deleted_users
+            and auth_versions.get(user_id, 0) == session.get('auth_version')):
+        return
+    
     conn = get_db_connection()
-    user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    user = conn.execute('''
+        SELECT id, username, role, is_active, auth_version FROM users WHERE id = ?
+    ''', (user_id,)).fetchone()
     conn.close()
-    return user and user['role'] == 'admin'
+    if not user or not user['is_active']:
+        session.clear()
+        return
+    remember_session_auth(user)
 
 def login_required(f):
     def wrapper(*args, **kwargs):
@@ -281,25 +2218,53 @@ def admin_required(f):
     wrapper.__name__ = f.__name__
     return wrapper
 
+# Worker processes
+def init_worker():
+    """Drop per-process resources a forked server worker inherited from its parent.
+
+    SQLite connections and executor threads must not cross a fork, so each
+    worker opens its own on first use. The warmed indexes are kept and patched
+    with other processes' changes by sync_catalog_changes.
+    """
+    global password_hash_pool, password_hash_slots, rate_limit_buckets
+    password_hash_pool = None
+    password_hash_slots = None
+    rate_limit_buckets = None
+    app.debug = False
+
+def shutdown_worker():
+    """Flush buffered writes and stop background work before a server process exits"""
+    view_counter.flush()
+    if password_hash_pool is not None:
+        password_hash_pool.shutdown(wait=False, cancel_futures=True)
+
 # Routes
 @app.route('/')
+@cached_page()
 def index():
     conn = get_db_connection()
     
-    # Get featured products based on highest ratings and recent activity
-    featured_products = conn.execute('''
+    # Featured products come from the materialized ranking (rating + recent sales)
+    featured_query = '''
         SELECT p.*, c.name as category_name 
-        FROM products p 
+        FROM featured_products f
+        JOIN products p ON f.product_id = p.id
         LEFT JOIN categories c ON p.category_id = c.id 
         WHERE p.is_active = 1 
-        ORDER BY p.average_rating DESC, p.total_reviews DESC, p.created_at DESC 
-        LIMIT 6
-    ''').fetchall()
+        ORDER BY f.rank
+        LIMIT ?
+    '''
+    featured_products = conn.execute(featured_query, (FEATURED_DISPLAY_COUNT,)).fetchall()
+    conn.close()
+    
+    if not featured_products:
+        # First run or empty ranking
+        refresh_featured_products()
+        featured_products = query_all(featured_query, (FEATURED_DISPLAY_COUNT,))
     
     # Get categories
-    categories = conn.execute('SELECT * FROM categories LIMIT 4').fetchall()
+    categories = sorted(get_categories(), key=lambda category: category['id'])[:4]
     
-    conn.close()
     return render_template('index.html', featured_products=featured_products, categories=categories)
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -329,7 +2294,11 @@ def register():
             return render_template('register.html')
         
         # Create new user
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
+        if password_hash is None:
+            conn.close()
+            flash('We are very busy right now. Please try again in a moment.', 'warning')
+            return render_template('register.html'), 503
         conn.execute('''
             INSERT INTO users (username, email, password_hash, full_name, phone)
             VALUES (?, ?, ?, ?, ?)
@@ -356,13 +2325,33 @@ def login():
         ).fetchone()
         conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
-            session['user_id'] = user['id']
-            session['username'] = user['username']
-            session['role'] = user['role']
+        verified = verify_password(user['password_hash'], password) if user else False
+        if verified is None:
+            flash('We are very busy right now. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
+        if verified:
+            if not user['is_active']:
+                flash('This account has been deactivated.', 'danger')
+                return render_template('login.html')
+            remember_session_auth(user)
+            
+            conn = get_db_connection()
+            if password_needs_rehash(user['password_hash']):
+                # Only this moment has the plain password; skip quietly if the pool is saturated
+                new_hash = hash_password(password)
+                if new_hash:
+                    conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                                 (new_hash, user['id'], user['password_hash']))
+                    conn.commit()
+            load_recently_viewed(conn, user['id'])
+            merged = merge_guest_cart(conn, user['id'])
+            conn.close()
             
             if user['role'] == 'admin':
                 return redirect(url_for('admin_dashboard'))
+            elif merged:
+                flash('Items you added before logging in are in your cart.', 'info')
+                return redirect(url_for('cart'))
             else:
                 return redirect(url_for('index'))
         else:
@@ -372,89 +2361,374 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if 'user_id' in session and session.get('recently_viewed_dirty'):
+        conn = get_db_connection()
+        save_recently_viewed(conn, session['user_id'], session.get('recently_viewed', []))
+        conn.commit()
+        conn.close()
     session.clear()
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
 
+@app.route('/session_state')
+def session_state():
+    """Personalized bits for cached catalog pages, fetched once per page by main.js"""
+    state = get_personal_state()
+    if not is_logged_in():
+        return jsonify({
+            'logged_in': False,
+            'cart_count': state['cart_count'],
+            'cart_product_ids': sorted(state['cart_product_ids'])
+        })
+    
+    return jsonify({
+        'logged_in': True,
+        'username': session.get('username'),
+        'role': session.get('role'),
+        'cart_count': state['cart_count'],
+        'cart_product_ids': sorted(state['cart_product_ids']),
+        'wishlist_product_ids': sorted(state['wishlist_product_ids'])
+    })
+
+@app.route('/cart_summary')
+def cart_summary():
+    """Header cart counter; served from the per-user personal state cache"""
+    state = get_personal_state()
+    return jsonify({
+        'success': True,
+        'items': state['cart_lines'],
+        'quantity': state['cart_count'],
+        'subtotal': state['cart_subtotal']
+    })
+
 @app.route('/products')
+@cached_page()
 def products():
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
     per_page = 12
     offset = (page - 1) * per_page
     
-    category_id = request.args.get('category')
     search = request.args.get('search', '')
     
-    conn = get_db_connection()
-    
-    # Build query
-    query = '''
-        SELECT p.*, c.name as category_name 
-        FROM products p 
-        LEFT JOIN categories c ON p.category_id = c.id 
-        WHERE p.is_active = 1
-    '''
-    params = []
-    
+    # Facet filters are answered from in-memory bitsets, not SQL
+    filters = {}
+    category_id = request.args.get('category', type=int)
     if category_id:
-        query += ' AND p.category_id = ?'
-        params.append(category_id)
+        filters['category'] = category_id
+    if request.args.get('price') in {bucket[0] for bucket in PRICE_BUCKETS}:
+        filters['price'] = request.args['price']
+    min_rating = request.args.get('rating', type=int)
+    if min_rating in RATING_FACETS:
+        filters['rating'] = min_rating
+    if request.args.get('in_stock'):
+        filters['in_stock'] = True
     
-    if search:
-        query += ' AND (p.name LIKE ? OR p.description LIKE ?)'
-        params.extend([f'%{search}%', f'%{search}%'])
-    
-    query += ' ORDER BY p.created_at DESC LIMIT ? OFFSET ?'
-    params.extend([per_page, offset])
+    conn = get_db_connection()
+    facets = get_facet_index()
     
-    products = conn.execute(query, params).fetchall()
+    restrict = None
+    if search:
+        matching_ids = [row['id'] for row in conn.execute('''
+            SELECT id FROM products
+            WHERE is_active = 1 AND (name LIKE ? OR description LIKE ?)
+        ''', (f'%{search}%', f'%{search}%')).fetchall()]
+        restrict = facets.bits_for_ids(matching_ids)
+    
+    result_bits, facet_counts = facets.query(filters, restrict)
+    total_products = result_bits.bit_count()
+    page_ids = facets.page(result_bits, offset, per_page)
+    
+    products = []
+    if page_ids:
+        rows = {row['id']: row for row in conn.execute(f'''
+            SELECT p.*, c.name as category_name 
+            FROM products p 
+            LEFT JOIN categories c ON p.category_id = c.id 
+            WHERE p.id IN ({','.join('?' * len(page_ids))})
+        ''', page_ids).fetchall()}
+        products = [rows[product_id] for product_id in page_ids if product_id in rows]
     
     # Get categories for filter
     categories = conn.execute('SELECT * FROM categories').fetchall()
     
     conn.close()
-    return render_template('products.html', products=products, categories=categories)
+    
+    total_pages = (total_products + per_page - 1) // per_page if total_products > 0 else 1
+    return render_template('products.html', products=products, categories=categories,
+                           facet_counts=facet_counts, filters=filters,
+                           price_buckets=PRICE_BUCKETS, rating_facets=RATING_FACETS,
+                           total_products=total_products, page=page, total_pages=total_pages)
+
+@app.template_global()
+def products_url(**changes):
+    """URL for the products page with some query arguments changed (None removes one)"""
+    args = request.args.to_dict()
+    args.pop('page', None)
+    for key, value in changes.items():
+        if value is None:
+            args.pop(key, None)
+        else:
+            args[key] = value
+    return url_for('products', **args)
+
+@app.route('/recently_viewed')
+def recently_viewed():
+    """Rendered "recently viewed" strip for the current visitor, hydrated in one query"""
+    exclude = request.args.get('exclude', type=int)
+    product_ids = [p for p in session.get('recently_viewed', []) if p != exclude]
+    
+    products = []
+    if product_ids:
+        conn = get_db_connection()
+        rows = {row['id']: row for row in conn.execute(f'''
+            SELECT id, name, price, image_url FROM products
+            WHERE id IN ({','.join('?' * len(product_ids))}) AND is_active = 1
+        ''', product_ids).fetchall()}
+        conn.close()
+        products = [rows[product_id] for product_id in product_ids if product_id in rows]
+    
+    return jsonify({
+        'count': len(products),
+        'html': render_template('recently_viewed.html', products=products) if products else ''
+    })
+
+@app.route('/search_suggestions')
+def search_suggestions():
+    """Typeahead completions for the nav search box, served from the in-memory index"""
+    results = get_search_index().search(request.args.get('q', ''))
+    return jsonify({
+        'products': [dict(item, url=url_for('product_detail', product_id=item['id']))
+                     for item in results['product']],
+        'categories': [dict(item, url=url_for('products', category=item['id']))
+                       for item in results['category']]
+    })
 
 @app.route('/product/<int:product_id>')
+@counts_product_view
+@cached_page(version=product_page_version)
 def product_detail(product_id):
     conn = get_db_connection()
     
-    product = conn.execute('''
-        SELECT p.*, c.name as category_name 
-        FROM products p 
-        LEFT JOIN categories c ON p.category_id = c.id 
-        WHERE p.id = ? AND p.is_active = 1
-    ''', (product_id,)).fetchone()
+    # Product, reviews and related products are cached as separate blocks so
+    # each write only evicts the block it affects
+    product = cached_fragment(
+        ('product', product_id, fragment_version('product', product_id), category_version),
+        lambda: conn.execute('''
+            SELECT p.*, c.name as category_name 
+            FROM products p 
+            LEFT JOIN categories c ON p.category_id = c.id 
+            WHERE p.id = ? AND p.is_active = 1
+        ''', (product_id,)).fetchone())
+    
+    if not product:
+        conn.close()
+        flash('Product not found.', 'danger')
+        return redirect(url_for('products'))
+    
+    product_categories[product_id] = product['category_id']
+    
+    # First page of reviews; the rest are loaded on demand from product_reviews()
+    reviews, next_cursor = cached_fragment(
+        ('reviews', product_id, fragment_version('reviews', product_id), 'newest'),
+        lambda: fetch_reviews_page(conn, product_id))
+    
+    # Related products: frequently bought together, topped up from the same category
+    def load_related_products():
+        related = get_recommended_products(conn, [product_id])
+        if len(related) < 4:
+            exclude = [product_id] + [p['id'] for p in related]
+            related += conn.execute(f'''
+                SELECT * FROM products 
+                WHERE category_id = ? AND id NOT IN ({','.join('?' * len(exclude))}) AND is_active = 1 
+                LIMIT ?
+            ''', [product['category_id'], *exclude, 4 - len(related)]).fetchall()
+        return related
+    
+    related_products = cached_fragment(
+        ('related', product_id, fragment_version('category', product['category_id']),
+         fragment_version('recommendations', product_id)),
+        load_related_products)
+    
+    conn.close()
+    return render_template('product_detail.html', product=product, reviews=reviews,
+                           next_cursor=next_cursor, related_products=related_products)
+
+@app.route('/product/<int:product_id>/reviews')
+def product_reviews(product_id):
+    """JSON page of rendered reviews for the "load more" button and sort selector"""
+    sort = request.args.get('sort', 'newest')
+    cursor = request.args.get('after')
+    
+    if sort not in REVIEW_SORTS:
+        return jsonify({'success': False, 'message': 'Invalid sort option'}), 400
+    
+    conn = get_db_connection()
+    try:
+        if cursor:
+            reviews, next_cursor = fetch_reviews_page(conn, product_id, sort, cursor)
+        else:
+            reviews, next_cursor = cached_fragment(
+                ('reviews', product_id, fragment_version('reviews', product_id), sort),
+                lambda: fetch_reviews_page(conn, product_id, sort))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    finally:
+        conn.close()
+    
+    return jsonify({
+        'success': True,
+        'html': render_template('review_list.html', reviews=reviews),
+        'next_cursor': next_cursor
+    })
+
+# Guest cart
+GUEST_CART_MAX_ITEMS = 50  # distinct products in a session cart, keeps the cookie small
+
+def get_guest_cart():
+    """Guest cart kept in the signed session cookie: {product_id (str): quantity}"""
+    return session.get('guest_cart', {})
+
+def save_guest_cart(guest_cart):
+    if guest_cart:
+        session['guest_cart'] = guest_cart
+    else:
+        session.pop('guest_cart', None)
+    session['guest_cart_version'] = session.get('guest_cart_version', 0) + 1
+    invalidate_personal_state()
+
+def load_guest_cart_items(conn):
+    """Hydrate the guest cart in one query, trimming lines to the stock on hand"""
+    guest_cart = get_guest_cart()
+    if not guest_cart:
+        return []
+    
+    products = {row['id']: row for row in conn.execute(f'''
+        SELECT id, name, price, image_url, stock_quantity, category_id FROM products
+        WHERE id IN ({','.join('?' * len(guest_cart))}) AND is_active = 1
+    ''', [int(product_id) for product_id in guest_cart]).fetchall()}
+    
+    items = []
+    trimmed = {}
+    for product_id, quantity in reversed(guest_cart.items()):
+        product = products.get(int(product_id))
+        if not product or product['stock_quantity'] <= 0:
+            if product:
+                flash(f'{product["name"]} is out of stock and removed from cart', 'warning')
+            continue
+        if product['stock_quantity'] < quantity:
+            quantity = product['stock_quantity']
+            flash(f'Updated {product["name"]} quantity to available stock ({quantity})', 'warning')
+        trimmed[product_id] = quantity
+        items.append({
+            'id': product['id'],  # guests address cart lines by product id
+            'product_id': product['id'],
+            'quantity': quantity,
+            'name': product['name'],
+            'price': product['price'],
+            'image_url': product['image_url'],
+            'stock_quantity': product['stock_quantity'],
+            'category_id': product['category_id'],
+            'subtotal': product['price'] * quantity
+        })
+    
+    if trimmed != guest_cart:
+        save_guest_cart(dict(reversed(trimmed.items())))
+    return items
+
+def merge_guest_cart(conn, user_id):
+    """Fold the session cart into the user's cart table in a single transaction"""
+    guest_cart = session.pop('guest_cart', None)
+    if not guest_cart:
+        return False
     
-    if not product:
-        flash('Product not found.', 'danger')
-        return redirect(url_for('products'))
+    conn.executemany('''
+        INSERT INTO cart (user_id, product_id, quantity, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, product_id) DO UPDATE
+        SET quantity = quantity + excluded.quantity, updated_at = excluded.updated_at
+    ''', [(user_id, int(product_id), quantity) for product_id, quantity in guest_cart.items()])
+    bump_cart_version(conn, user_id)
+    conn.commit()
+    invalidate_personal_state(user_id)
+    return True
+
+def add_to_guest_cart(product_id, quantity):
+    """Add to the session cart; only reads the product, never writes"""
+    guest_cart = dict(get_guest_cart())
+    key = str(product_id)
+    if key not in guest_cart and len(guest_cart) >= GUEST_CART_MAX_ITEMS:
+        return False, f'Your cart can hold up to {GUEST_CART_MAX_ITEMS} products. Please log in to add more.'
     
-    # Get reviews
-    reviews = conn.execute('''
-        SELECT r.*, u.username, u.full_name
-        FROM reviews r
-        JOIN users u ON r.user_id = u.id
-        WHERE r.product_id = ?
-        ORDER BY r.created_at DESC
-    ''', (product_id,)).fetchall()
+    conn = get_db_connection()
+    product = conn.execute(
+        'SELECT id FROM products WHERE id = ? AND is_active = 1', (product_id,)
+    ).fetchone()
+    conn.close()
+    if not product:
+        return False, 'Product not found.'
     
-    # Get related products
-    related_products = conn.execute('''
-        SELECT * FROM products 
-        WHERE category_id = ? AND id != ? AND is_active = 1 
-        LIMIT 4
-    ''', (product['category_id'], product_id)).fetchall()
+    guest_cart[key] = guest_cart.get(key, 0) + quantity
+    save_guest_cart(guest_cart)
+    return True, 'Product added to cart!'
+
+def get_cart_version(conn):
+    if not is_logged_in():
+        return session.get('guest_cart_version', 0)
+    row = conn.execute(
+        'SELECT version FROM cart_versions WHERE user_id = ?', (session['user_id'],)
+    ).fetchone()
+    return row['version'] if row else 0
+
+def bump_cart_version(conn, user_id):
+    return conn.execute('''
+        INSERT INTO cart_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+        RETURNING version
+    ''', (user_id,)).fetchone()['version']
+
+def cart_snapshot(conn):
+    """Version and full totals after a cart write.
+
+    For a logged-in user this runs inside the mutating transaction, before
+    the commit, so the figures match exactly the write that produced them.
+    """
+    if not is_logged_in():
+        guest_cart = get_guest_cart()
+        version = session.get('guest_cart_version', 0)
+        items = [{'product_id': row['id'], 'category_id': row['category_id'],
+                  'quantity': guest_cart[str(row['id'])],
+                  'subtotal': guest_cart[str(row['id'])] * row['price']} for row in query_all(f'''
+            SELECT id, category_id, price FROM products
+            WHERE id IN ({','.join('?' * len(guest_cart))}) AND is_active = 1
+        ''', [int(product_id) for product_id in guest_cart])] if guest_cart else []
+    else:
+        version = bump_cart_version(conn, session['user_id'])
+        items = conn.execute('''
+            SELECT c.product_id, p.category_id, c.quantity, (c.quantity * p.price) as subtotal
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = ? AND p.is_active = 1
+        ''', (session['user_id'],)).fetchall()
     
-    conn.close()
-    return render_template('product_detail.html', product=product, reviews=reviews, related_products=related_products)
+    totals = quote_cart(items, session.get('coupon_code'))
+    promotion = totals.pop('promotion')
+    return {'version': version, 'items': len(items),
+            'quantity': sum(item['quantity'] for item in items),
+            'promotion': promotion and {'code': promotion['code'], 'description': promotion['description']},
+            **totals}
 
 @app.route('/add_to_cart', methods=['POST'])
-@login_required
 def add_to_cart():
     product_id = request.form['product_id']
     quantity = int(request.form.get('quantity', 1))
     
+    if not is_logged_in():
+        success, message = add_to_guest_cart(int(product_id), quantity)
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.headers.get('Content-Type') == 'application/x-www-form-urlencoded':
+            return jsonify({'success': success, 'message': message,
+                            'cart': cart_snapshot(None) if success else None})
+        flash(message, 'success' if success else 'danger')
+        return redirect(url_for('product_detail', product_id=product_id))
+    
     conn = get_db_connection()
     
     # Check if item already in cart
@@ -466,28 +2740,29 @@ def add_to_cart():
     if existing_item:
         # Update quantity
         conn.execute(
-            'UPDATE cart SET quantity = quantity + ? WHERE user_id = ? AND product_id = ?',
+            'UPDATE cart SET quantity = quantity + ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ? AND product_id = ?',
             (quantity, session['user_id'], product_id)
         )
     else:
         # Add new item
         conn.execute(
-            'INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)',
+            'INSERT INTO cart (user_id, product_id, quantity, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
             (session['user_id'], product_id, quantity)
         )
     
+    cart = cart_snapshot(conn)
     conn.commit()
+    invalidate_personal_state()
     conn.close()
     
     # Check if it's an AJAX request
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.headers.get('Content-Type') == 'application/x-www-form-urlencoded':
-        return jsonify({'success': True, 'message': 'Product added to cart!'})
+        return jsonify({'success': True, 'message': 'Product added to cart!', 'cart': cart})
     
     flash('Product added to cart!', 'success')
     return redirect(url_for('product_detail', product_id=product_id))
 
 @app.route('/remove_from_cart', methods=['POST'])
-@login_required
 def remove_from_cart():
     cart_id = request.form.get('cart_id')
     
@@ -497,32 +2772,42 @@ def remove_from_cart():
         flash('Invalid request.', 'danger')
         return redirect(url_for('cart'))
     
-    conn = get_db_connection()
-    
-    # Verify the cart item belongs to the current user
-    cart_item = conn.execute('''
-        SELECT * FROM cart WHERE id = ? AND user_id = ?
-    ''', (cart_id, session['user_id'])).fetchone()
-    
-    if cart_item:
-        conn.execute('DELETE FROM cart WHERE id = ?', (cart_id,))
-        conn.commit()
-        success = True
-        message = 'Item removed from cart!'
+    cart = None
+    if not is_logged_in():
+        guest_cart = dict(get_guest_cart())
+        success = guest_cart.pop(cart_id, None) is not None
+        message = 'Item removed from cart!' if success else 'Item not found in cart'
+        if success:
+            save_guest_cart(guest_cart)
+            cart = cart_snapshot(None)
     else:
-        success = False
-        message = 'Item not found or access denied'
-    
-    conn.close()
+        conn = get_db_connection()
+        
+        # Verify the cart item belongs to the current user
+        cart_item = conn.execute('''
+            SELECT * FROM cart WHERE id = ? AND user_id = ?
+        ''', (cart_id, session['user_id'])).fetchone()
+        
+        if cart_item:
+            conn.execute('DELETE FROM cart WHERE id = ?', (cart_id,))
+            cart = cart_snapshot(conn)
+            conn.commit()
+            invalidate_personal_state()
+            success = True
+            message = 'Item removed from cart!'
+        else:
+            success = False
+            message = 'Item not found or access denied'
+        
+        conn.close()
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return jsonify({'success': success, 'message': message})
+        return jsonify({'success': success, 'message': message, 'cart': cart})
     
     flash(message, 'success' if success else 'danger')
     return redirect(url_for('cart'))
 
 @app.route('/update_cart_quantity', methods=['POST'])
-@login_required
 def update_cart_quantity():
     cart_id = request.form.get('cart_id')
     new_quantity = request.form.get('quantity')
@@ -544,17 +2829,32 @@ def update_cart_quantity():
         return redirect(url_for('cart'))
     
     conn = get_db_connection()
+    cart = None
     
-    # Verify the cart item belongs to the current user
-    cart_item = conn.execute('''
-        SELECT c.*, p.price FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.id = ? AND c.user_id = ?
-    ''', (cart_id, session['user_id'])).fetchone()
+    if not is_logged_in():
+        guest_cart = dict(get_guest_cart())
+        cart_item = conn.execute(
+            'SELECT price FROM products WHERE id = ? AND is_active = 1', (cart_id,)
+        ).fetchone() if cart_id in guest_cart else None
+        if cart_item:
+            guest_cart[cart_id] = new_quantity
+            save_guest_cart(guest_cart)
+            cart = cart_snapshot(conn)
+    else:
+        # Verify the cart item belongs to the current user
+        cart_item = conn.execute('''
+            SELECT c.*, p.price FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.id = ? AND c.user_id = ?
+        ''', (cart_id, session['user_id'])).fetchone()
+        
+        if cart_item:
+            conn.execute('UPDATE cart SET quantity = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?', (new_quantity, cart_id))
+            cart = cart_snapshot(conn)
+            conn.commit()
+            invalidate_personal_state()
     
     if cart_item:
-        conn.execute('UPDATE cart SET quantity = ? WHERE id = ?', (new_quantity, cart_id))
-        conn.commit()
         new_subtotal = float(cart_item['price']) * new_quantity
         success = True
         message = 'Quantity updated!'
@@ -569,26 +2869,66 @@ def update_cart_quantity():
         return jsonify({
             'success': success, 
             'message': message,
-            'new_subtotal': new_subtotal
+            'new_subtotal': new_subtotal,
+            'cart': cart
         })
     
     flash(message, 'success' if success else 'danger')
     return redirect(url_for('cart'))
 
+@app.route('/apply_coupon', methods=['POST'])
+def apply_coupon():
+    code = normalize_coupon_code(request.form.get('code'))
+    promotion = get_promotion_index().by_code.get(code)
+    if not promotion:
+        success, message = False, 'Invalid or expired coupon code.'
+    else:
+        session['coupon_code'] = code
+        success, message = True, f'Coupon {code} applied: {promotion["description"]}'
+    return coupon_response(success, message)
+
+@app.route('/remove_coupon', methods=['POST'])
+def remove_coupon():
+    session.pop('coupon_code', None)
+    return coupon_response(True, 'Coupon removed.')
+
+def coupon_response(success, message):
+    """Reply to a coupon change with fresh totals, which say whether the coupon won"""
+    cart = None
+    if success:
+        if is_logged_in():
+            conn = get_db_connection()
+            cart = cart_snapshot(conn)
+            conn.commit()
+            conn.close()
+        else:
+            session['guest_cart_version'] = session.get('guest_cart_version', 0) + 1
+            cart = cart_snapshot(None)
+        code = session.get('coupon_code')
+        if code and (cart['promotion'] or {}).get('code') != code:
+            message = f'Coupon {code} saved, but it does not lower this cart\'s total yet.'
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': success, 'message': message, 'cart': cart})
+    flash(message, 'success' if success else 'danger')
+    return redirect(url_for('cart'))
+
 @app.route('/cart')
-@login_required
 def cart():
     conn = get_db_connection()
     
     # Get cart items with product details and stock verification
-    cart_items = conn.execute('''
-        SELECT c.*, p.name, p.price, p.image_url, p.stock_quantity,
-               (c.quantity * p.price) as subtotal
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id = ? AND p.is_active = 1
-        ORDER BY c.created_at DESC
-    ''', (session['user_id'],)).fetchall()
+    if not is_logged_in():
+        cart_items = load_guest_cart_items(conn)
+    else:
+        cart_items = conn.execute('''
+            SELECT c.*, p.name, p.price, p.image_url, p.stock_quantity, p.category_id,
+                   (c.quantity * p.price) as subtotal
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = ? AND p.is_active = 1
+            ORDER BY c.created_at DESC
+        ''', (session['user_id'],)).fetchall()
     
     # Remove items that are out of stock
     valid_items = []
@@ -616,20 +2956,28 @@ def cart():
         else:
             valid_items.append(item)
     
+    if is_logged_in() and any(item['stock_quantity'] < item['quantity'] for item in cart_items):
+        bump_cart_version(conn, session['user_id'])
+        invalidate_personal_state()
     conn.commit()
+    cart_version = get_cart_version(conn)
     
     # Calculate totals
     if valid_items:
-        subtotal = sum(item['subtotal'] for item in valid_items)
-        order_totals = calculate_order_total(subtotal)
+        order_totals = quote_cart(valid_items, session.get('coupon_code'))
+        subtotal = order_totals['subtotal']
     else:
         subtotal = 0
-        order_totals = {'subtotal': 0, 'gst': 0, 'shipping': 0, 'total': 0}
+        order_totals = {'subtotal': 0, 'gst': 0, 'shipping': 0, 'total': 0, 'discount': 0, 'promotion': None}
+    
+    recommended_products = get_recommended_products(conn, [item['product_id'] for item in valid_items])
     
     conn.close()
     
     return render_template('cart.html', 
                          cart_items=valid_items,
+                         cart_version=cart_version,
+                         recommended_products=recommended_products,
                          **order_totals)
 
 @app.route('/checkout')
@@ -639,7 +2987,7 @@ def checkout():
     
     # Get cart items with stock verification
     cart_items = conn.execute('''
-        SELECT c.*, p.name, p.price, p.image_url, p.stock_quantity,
+        SELECT c.*, p.name, p.price, p.image_url, p.stock_quantity, p.category_id,
                (c.quantity * p.price) as subtotal
         FROM cart c
         JOIN products p ON c.product_id = p.id
@@ -683,12 +3031,12 @@ def checkout():
         for issue in stock_issues:
             flash(issue, 'warning')
         conn.commit()
+        invalidate_personal_state()
         conn.close()
         return redirect(url_for('cart'))
     
     # Calculate order totals
-    subtotal = sum(item['subtotal'] for item in valid_items)
-    order_totals = calculate_order_total(subtotal)
+    order_totals = quote_cart(valid_items, session.get('coupon_code'))
     
     conn.close()
     
@@ -718,7 +3066,8 @@ def place_order():
     try:
         # Get cart items with final stock check
         cart_items = conn.execute('''
-            SELECT c.*, p.price, p.name, p.stock_quantity
+            SELECT c.*, p.price, p.name, p.stock_quantity, p.category_id,
+                   (c.quantity * p.price) as subtotal
             FROM cart c
             JOIN products p ON c.product_id = p.id
             WHERE c.user_id = ? AND p.is_active = 1
@@ -737,9 +3086,23 @@ def place_order():
                 return redirect(url_for('cart'))
         
         # Calculate final totals
-        subtotal = sum(item['quantity'] * item['price'] for item in cart_items)
-        order_totals = calculate_order_total(subtotal)
+        coupon_code = session.get('coupon_code')
+        order_totals = quote_cart(cart_items, coupon_code)
         final_total = order_totals['total']
+        promotion = order_totals['promotion']
+        
+        # A coupon used up by other orders since checkout drops out of the quote;
+        # never charge the full price for an order placed expecting the discount
+        coupon_gone = (coupon_code and (promotion or {}).get('code') != coupon_code
+                       and coupon_code not in get_promotion_index().by_code)
+        
+        # Claim the promotion first; the redemption limit is checked in the same transaction
+        if coupon_gone or promotion and not redeem_promotion(conn, promotion):
+            conn.rollback()
+            conn.close()
+            session.pop('coupon_code', None)
+            flash('That offer has just run out. Please review your cart total.', 'warning')
+            return redirect(url_for('cart'))
         
         # Generate tracking number
         tracking_number = 'MP' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
@@ -747,12 +3110,16 @@ def place_order():
         # Create order
         cursor = conn.execute('''
             INSERT INTO orders (user_id, total_amount, shipping_address, city, state, 
-                              postal_code, phone, payment_method, tracking_number, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                              postal_code, phone, payment_method, tracking_number, status,
+                              discount_amount, promotion_id, estimated_delivery)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now', ?))
         ''', (session['user_id'], final_total, shipping_address, city, state, postal_code, 
-              phone, payment_method, tracking_number, 'pending'))
+              phone, payment_method, tracking_number, 'pending',
+              order_totals['discount'], promotion['id'] if promotion else None,
+              f'+{ORDER_DELIVERY_DAYS} days'))
         
         order_id = cursor.lastrowid
+        record_order_events(conn, [(order_id, None, 'pending', final_total, None, session['user_id'])])
         
         # Add order items and update stock
         for item in cart_items:
@@ -768,11 +3135,22 @@ def place_order():
                 WHERE id = ?
             ''', (item['quantity'], item['product_id']))
         
+        # Update the co-purchase index in the same transaction
+        record_copurchases(conn, [item['product_id'] for item in cart_items])
+        
         # Clear user's cart
         conn.execute('DELETE FROM cart WHERE user_id = ?', (session['user_id'],))
+        bump_cart_version(conn, session['user_id'])
         
         conn.commit()
+        invalidate_personal_state()
         conn.close()
+        session.pop('coupon_code', None)
+        for item in cart_items:
+            invalidate_product(item['product_id'])
+            invalidate_recommendations(item['product_id'])
+        refresh_facets([item['product_id'] for item in cart_items])
+        update_featured_products([item['product_id'] for item in cart_items])
         
         flash(f'Order #{order_id} placed successfully! Your tracking number is {tracking_number}', 'success')
         return redirect(url_for('my_orders'))
@@ -823,17 +3201,19 @@ def my_orders():
         orders = conn.execute('''
             SELECT o.id, o.total_amount, o.status, o.shipping_address, o.city, o.state, 
                    o.postal_code, o.phone, o.payment_method, o.payment_status,
-                   o.tracking_number, o.created_at
+                   o.tracking_number, o.estimated_delivery, o.delivered_at, o.created_at
             FROM orders o
             WHERE o.user_id = ?
             ORDER BY o.created_at DESC
             LIMIT ? OFFSET ?
         ''', (session['user_id'], per_page, offset)).fetchall()
+        timelines = get_order_timelines(conn, [order['id'] for order in orders])
         
         # Process orders and get additional data
         orders_list = []
         for order in orders:
             order_dict = dict(order)
+            order_dict['timeline'] = timelines[order['id']]
             
             # Get order items for this order
             order_items = conn.execute('''
@@ -1053,6 +3433,7 @@ def add_to_wishlist():
             VALUES (?, ?)
         ''', (session['user_id'], product_id))
         conn.commit()
+        invalidate_personal_state()
         message = 'Product added to wishlist!'
         success = True
     
@@ -1078,6 +3459,7 @@ def remove_from_wishlist(wishlist_id):
     if wishlist_item:
         conn.execute('DELETE FROM wishlist WHERE id = ?', (wishlist_id,))
         conn.commit()
+        invalidate_personal_state()
         flash('Product removed from wishlist.', 'success')
     
     conn.close()
@@ -1101,6 +3483,7 @@ def remove_from_wishlist_ajax():
     if wishlist_item:
         conn.execute('DELETE FROM wishlist WHERE id = ?', (wishlist_id,))
         conn.commit()
+        invalidate_personal_state()
         conn.close()
         return jsonify({'success': True, 'message': 'Product removed from wishlist'})
     else:
@@ -1128,39 +3511,44 @@ def move_to_cart(wishlist_id):
         if existing_cart:
             # Update quantity
             conn.execute('''
-                UPDATE cart SET quantity = quantity + 1 WHERE user_id = ? AND product_id = ?
+                UPDATE cart SET quantity = quantity + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND product_id = ?
             ''', (session['user_id'], product_id))
         else:
             # Add to cart
             conn.execute('''
-                INSERT INTO cart (user_id, product_id, quantity)
-                VALUES (?, ?, 1)
+                INSERT INTO cart (user_id, product_id, quantity, updated_at)
+                VALUES (?, ?, 1, CURRENT_TIMESTAMP)
             ''', (session['user_id'], product_id))
         
         # Remove from wishlist
         conn.execute('DELETE FROM wishlist WHERE id = ?', (wishlist_id,))
+        bump_cart_version(conn, session['user_id'])
         conn.commit()
+        invalidate_personal_state()
         flash('Product moved to cart!', 'success')
     
     conn.close()
     return redirect(url_for('wishlist'))
 
+def cancel_pending_order(conn, order_id, reason, actor_id=None):
+    """Cancel a pending order and put its stock back in one transaction.
+
+    The status guard on the UPDATE decides the race with a concurrent
+    status change or a repeated request: only the caller that flips the
+    row restocks. Returns the restocked product ids, or None when the
+    order was no longer pending.
+    """
+    if not transition_order(conn, order_id, 'cancelled', reason, actor_id):
+        conn.rollback()
+        return None
+    product_ids = order_product_ids(conn, [order_id])
+    conn.commit()
+    return product_ids
+
 @app.route('/cancel_order/<int:order_id>', methods=['POST'])
 @login_required
 def cancel_order(order_id):
-    conn = get_db_connection()
-    
-    # Get order to check ownership and status
-    order = conn.execute('''
-        SELECT * FROM orders WHERE id = ? AND user_id = ?
-    ''', (order_id, session['user_id'])).fetchone()
-    
-    if not order:
-        return jsonify({'success': False, 'message': 'Order not found'})
-    
-    if order['status'] != 'pending':
-        return jsonify({'success': False, 'message': 'Order cannot be cancelled'})
-    
     # Get reason from JSON or form data, default to customer cancellation
     reason = 'Cancelled by customer'
     try:
@@ -1171,25 +3559,28 @@ def cancel_order(order_id):
     except:
         pass
     
-    # Update order status
-    conn.execute('''
-        UPDATE orders SET status = 'cancelled', notes = ?
-        WHERE id = ?
-    ''', (reason, order_id))
-    
-    # Restore stock quantities
-    order_items = conn.execute('''
-        SELECT product_id, quantity FROM order_items WHERE order_id = ?
-    ''', (order_id,)).fetchall()
-    
-    for item in order_items:
-        conn.execute('''
-            UPDATE products SET stock_quantity = stock_quantity + ?
-            WHERE id = ?
-        ''', (item['quantity'], item['product_id']))
+    conn = get_db_connection()
+    try:
+        # Check ownership; the status itself is checked by the guarded update
+        order = conn.execute('''
+            SELECT id FROM orders WHERE id = ? AND user_id = ?
+        ''', (order_id, session['user_id'])).fetchone()
+        if not order:
+            return jsonify({'success': False, 'message': 'Order not found'})
+        
+        product_ids = cancel_pending_order(conn, order_id, reason, session['user_id'])
+        if product_ids is None:
+            status = conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()['status']
+            if status == 'cancelled':
+                return jsonify({'success': True, 'message': 'Order is already cancelled'})
+            return jsonify({'success': False, 'message': 'Order cannot be cancelled'})
+    finally:
+        conn.close()
     
-    conn.commit()
-    conn.close()
+    for product_id in product_ids:
+        invalidate_product(product_id)
+    refresh_facets(product_ids)
+    update_featured_products(product_ids)
     
     return jsonify({'success': True, 'message': 'Order cancelled successfully'})
 
@@ -1234,8 +3625,9 @@ def admin_dashboard():
     # Get stats
     total_users = conn.execute('SELECT COUNT(*) as count FROM users WHERE role = "user"').fetchone()['count']
     total_products = conn.execute('SELECT COUNT(*) as count FROM products WHERE is_active = 1').fetchone()['count']
-    total_orders = conn.execute('SELECT COUNT(*) as count FROM orders').fetchone()['count']
-    total_revenue = conn.execute('SELECT COALESCE(SUM(total_amount), 0) as revenue FROM orders').fetchone()['revenue']
+    order_counts = get_order_status_counts(conn)
+    total_orders = order_counts['total_orders']
+    total_revenue = order_counts['total_revenue']
     
     # Recent orders
     recent_orders = conn.execute('''
@@ -1301,7 +3693,7 @@ def admin_add_product():
             image_url = '/static/images/default-product.jpg'
         
         conn = get_db_connection()
-        conn.execute('''
+        cursor = conn.execute('''
             INSERT INTO products (name, description, detailed_description, price, category_id, 
                                 image_url, stock_quantity, benefits, usage_instructions, warnings)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -1310,6 +3702,10 @@ def admin_add_product():
         
         conn.commit()
         conn.close()
+        invalidate_product(cursor.lastrowid, category_id)
+        index_product_for_search(cursor.lastrowid, name)
+        refresh_facets([cursor.lastrowid])
+        update_featured_products([cursor.lastrowid])
         
         flash('Product added successfully!', 'success')
         return redirect(url_for('admin_products'))
@@ -1320,6 +3716,230 @@ def admin_add_product():
     
     return render_template('admin/product_form.html', categories=categories)
 
+# Bulk catalog import
+PRODUCT_IMPORT_BATCH = 500  # rows upserted per transaction
+PRODUCT_IMPORT_ERROR_LIMIT = 200  # per-row errors kept for the report
+PRODUCT_IMPORT_TEXT_COLUMNS = ('description', 'detailed_description', 'image_url',
+                               'benefits', 'usage_instructions', 'warnings')
+DEFAULT_PRODUCT_IMAGE = '/static/images/default-product.jpg'
+
+def read_import_rows(file, fmt):
+    """Yield (line number, row) from an uploaded CSV or JSON Lines file without reading it whole"""
+    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig')
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(stream, start=1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+def parse_product_row(row, exists, category_id):
+    """Validate one import row into {column: value}; raises ValueError with the message to report"""
+    def field(name):
+        value = row.get(name)
+        return value.strip() if isinstance(value, str) else value
+    
+    values = {}
+    if field('name') is not None:
+        if not field('name'):
+            raise ValueError('name is empty')
+        values['name'] = field('name')
+    if field('price') not in (None, ''):
+        try:
+            values['price'] = float(field('price'))
+        except (TypeError, ValueError):
+            raise ValueError(f"price {field('price')!r} is not a number")
+        if values['price'] < 0 or not math.isfinite(values['price']):
+            raise ValueError('price must be a non-negative number')
+    if field('stock_quantity') not in (None, ''):
+        try:
+            values['stock_quantity'] = int(float(field('stock_quantity')))
+        except (TypeError, ValueError):
+            raise ValueError(f"stock_quantity {field('stock_quantity')!r} is not a whole number")
+        if values['stock_quantity'] < 0:
+            raise ValueError('stock_quantity must not be negative')
+    if field('is_active') not in (None, ''):
+        flag = str(field('is_active')).lower()
+        if flag not in ('1', '0', 'true', 'false', 'yes', 'no'):
+            raise ValueError(f"is_active {field('is_active')!r} is not 1/0 or true/false")
+        values['is_active'] = 1 if flag in ('1', 'true', 'yes') else 0
+    if category_id is not None:
+        values['category_id'] = category_id
+    for column in PRODUCT_IMPORT_TEXT_COLUMNS:
+        if field(column) is not None:
+            values[column] = str(field(column))
+    
+    if not exists:
+        missing = [column for column in ('name', 'price', 'category_id') if column not in values]
+        if missing:
+            raise ValueError('new products need ' + ', '.join(missing).replace('category_id', 'category'))
+        for column in PRODUCT_IMPORT_TEXT_COLUMNS:
+            values.setdefault(column, '')
+        values['image_url'] = values['image_url'] or DEFAULT_PRODUCT_IMAGE
+    return values
+
+def upsert_products(conn, rows, existing):
+    """Write validated (product id or None, values) rows, one executemany per column set.
+
+    Existing products get an UPDATE of just the columns supplied; the rest
+    are inserted, keeping an id from the file so exports round-trip.
+    """
+    statements = defaultdict(list)
+    for product_id, values in rows:
+        columns = tuple(sorted(values))
+        if product_id in existing:
+            statements[('update', columns)].append([values[column] for column in columns] + [product_id])
+        else:
+            statements[('insert', columns)].append([product_id] + [values[column] for column in columns])
+    for (kind, columns), params in statements.items():
+        if kind == 'update':
+            conn.executemany(f'''
+                UPDATE products SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?
+            ''', params)
+        else:
+            conn.executemany(f'''
+                INSERT INTO products (id, {', '.join(columns)}) VALUES (?, {', '.join('?' * len(columns))})
+            ''', params)
+
+def import_products(conn, rows, create_categories=False):
+    """Validate and upsert catalog rows in transactions of PRODUCT_IMPORT_BATCH rows.
+
+    Rows with the id of an existing product update just the columns they
+    carry; rows without one (or with an unknown id) create a product.
+    Categories are matched by name, case-insensitively. Invalid rows are
+    skipped and reported; the rest of the file still goes in.
+    """
+    categories = {row['name'].strip().lower(): row['id']
+                  for row in conn.execute('SELECT id, name FROM categories')}
+    category_ids = set(categories.values())
+    report = {'created': 0, 'updated': 0, 'failed': 0, 'categories_created': [], 'errors': []}
+    
+    def fail(number, message):
+        report['failed'] += 1
+        if len(report['errors']) < PRODUCT_IMPORT_ERROR_LIMIT:
+            report['errors'].append({'row': number, 'error': message})
+    
+    def flush(chunk):
+        raw_ids = {str(row.get('id')).strip() for _, row in chunk if str(row.get('id') or '').strip().isdigit()}
+        existing = set()
+        if raw_ids:
+            existing = {r['id'] for r in conn.execute(f'''
+                SELECT id FROM products WHERE id IN ({','.join('?' * len(raw_ids))})
+            ''', [int(product_id) for product_id in raw_ids])}
+        valid = []
+        valid_numbers = []  # file row of each entry in valid
+        chunk_categories = []
+        for number, row in chunk:
+            try:
+                raw_id = str(row.get('id') or '').strip()
+                if raw_id and not raw_id.isdigit():
+                    raise ValueError(f'id {raw_id!r} is not a product id')
+                product_id = int(raw_id) if raw_id else None
+                
+                category_id = None
+                category_name = str(row.get('category') or '').strip()
+                if category_name:
+                    category_id = categories.get(category_name.lower())
+                    if category_id is None:
+                        if not create_categories:
+                            raise ValueError(f'unknown category {category_name!r}')
+                        category_id = conn.execute("INSERT INTO categories (name, description) VALUES (?, '')",
+                                                   (category_name,)).lastrowid
+                        categories[category_name.lower()] = category_id
+                        category_ids.add(category_id)
+                        report['categories_created'].append(category_name)
+                        chunk_categories.append(category_name)
+                elif str(row.get('category_id') or '').strip():
+                    raw_category_id = str(row['category_id']).strip()
+                    category_id = int(raw_category_id) if raw_category_id.isdigit() else None
+                    if category_id not in category_ids:
+                        raise ValueError(f"unknown category_id {row['category_id']!r}")
+                
+                values = parse_product_row(row, product_id in existing, category_id)
+            except ValueError as e:
+                fail(number, str(e))
+                continue
+            valid.append((product_id, values))
+            valid_numbers.append(number)
+        
+        try:
+            upsert_products(conn, valid, existing)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            # Rows that failed validation were already reported
+            for number in valid_numbers:
+                fail(number, f'not saved: {e}')
+            # Categories created in this chunk were rolled back with it
+            for name in chunk_categories:
+                report['categories_created'].remove(name)
+                category_ids.discard(categories.pop(name.lower()))
+            return
+        for product_id, _ in valid:
+            if product_id in existing:
+                report['updated'] += 1
+            else:
+                report['created'] += 1
+    
+    chunk = []
+    try:
+        for number, row in rows:
+            if not isinstance(row, dict):
+                fail(number, 'not a valid JSON object')
+                continue
+            chunk.append((number, row))
+            if len(chunk) >= PRODUCT_IMPORT_BATCH:
+                flush(chunk)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        fail(None, f'file could not be read past this point: {e}')
+    if chunk:
+        flush(chunk)
+    return report
+
+def rebuild_catalog_indexes(categories_changed=False):
+    """Rebuild everything derived from the catalog once, after a bulk write"""
+    rebuild_search_index_in_background()
+    rebuild_facet_index_in_background()
+    if categories_changed:
+        invalidate_categories()
+    refresh_featured_products()
+    page_cache.clear()
+    fragment_cache.clear()
+    personal_state_cache.clear()
+    publish_catalog_change('catalog')
+
+@app.route('/admin/products/import', methods=['POST'])
+@admin_required
+def admin_import_products():
+    """Bulk create or update products from a CSV or JSON Lines file (the format admin_export writes)"""
+    file = request.files.get('catalog_file')
+    if not file or not file.filename:
+        flash('Please choose a CSV or JSON Lines file to import.', 'danger')
+        return redirect(url_for('admin_products'))
+    fmt = 'jsonl' if file.filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+    
+    conn = get_db_connection()
+    try:
+        report = import_products(conn, read_import_rows(file, fmt), bool(request.form.get('create_categories')))
+    finally:
+        conn.close()
+    if report['created'] or report['updated'] or report['categories_created']:
+        rebuild_catalog_indexes(bool(report['categories_created']))
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': True, **report})
+    flash(f"Imported products: {report['created']} created, {report['updated']} updated, "
+          f"{report['failed']} rejected.", 'success' if not report['failed'] else 'warning')
+    for error in report['errors'][:10]:
+        flash(f"Row {error['row']}: {error['error']}" if error['row'] else error['error'], 'danger')
+    return redirect(url_for('admin_products'))
+
 @app.route('/admin/users')
 @admin_required
 def admin_users():
@@ -1362,6 +3982,7 @@ def admin_edit_user(user_id):
                 WHERE id = ?
             ''', (username, email, full_name, phone, address, city, state, 
                   postal_code, role, is_active, user_id))
+            bump_auth_version(conn, user_id)
             
             conn.commit()
             flash('User updated successfully!', 'success')
@@ -1393,10 +4014,12 @@ def admin_delete_user(user_id):
     if orders_count > 0:
         # Deactivate instead of delete
         conn.execute('UPDATE users SET is_active = 0 WHERE id = ?', (user_id,))
+        bump_auth_version(conn, user_id)
         flash('User account deactivated (has order history).', 'warning')
     else:
         # Safe to delete
         conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        bump_auth_version(conn, user_id, deleted=True)
         flash('User deleted successfully!', 'success')
     
     conn.commit()
@@ -1436,7 +4059,11 @@ def admin_add_user():
             return render_template('admin/add_user.html', states=INDIAN_STATES)
         
         # Create new user
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
+        if password_hash is None:
+            conn.close()
+            flash('Password hashing is busy right now. Please try again.', 'warning')
+            return render_template('admin/add_user.html', states=INDIAN_STATES)
         conn.execute('''
             INSERT INTO users (username, email, password_hash, full_name, phone,
                              address, city, state, postal_code, role)
@@ -1452,6 +4079,23 @@ def admin_add_user():
     
     return render_template('admin/add_user.html', states=INDIAN_STATES)
 
+def order_filter_clause(status_filter, search_query):
+    """WHERE clause and params for the admin order filters, over orders o JOIN users u"""
+    conditions = []
+    params = []
+    
+    if status_filter:
+        conditions.append('o.status = ?')
+        params.append(status_filter)
+    
+    if search_query:
+        conditions.append('(u.full_name LIKE ? OR u.email LIKE ? OR o.tracking_number LIKE ?)')
+        search_param = f'%{search_query}%'
+        params.extend([search_param, search_param, search_param])
+    
+    where_clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return where_clause, params
+
 @app.route('/admin/orders')
 @admin_required
 def admin_orders():
@@ -1474,19 +4118,7 @@ def admin_orders():
         LEFT JOIN order_items oi ON o.id = oi.order_id
     '''
     
-    conditions = []
-    params = []
-    
-    if status_filter:
-        conditions.append('o.status = ?')
-        params.append(status_filter)
-    
-    if search_query:
-        conditions.append('(u.full_name LIKE ? OR u.email LIKE ? OR o.tracking_number LIKE ?)')
-        search_param = f'%{search_query}%'
-        params.extend([search_param, search_param, search_param])
-    
-    where_clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    where_clause, params = order_filter_clause(status_filter, search_query)
     
     # Get orders with pagination
     orders_query = base_query + where_clause + '''
@@ -1508,17 +4140,7 @@ def admin_orders():
     total_orders = conn.execute(count_query, params[:-2]).fetchone()['count']
     
     # Get order statistics
-    stats = conn.execute('''
-        SELECT 
-            COUNT(*) as total_orders,
-            SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending_orders,
-            SUM(CASE WHEN status = 'processing' THEN 1 ELSE 0 END) as processing_orders,
-            SUM(CASE WHEN status = 'shipped' THEN 1 ELSE 0 END) as shipped_orders,
-            SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) as delivered_orders,
-            SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END) as cancelled_orders,
-            SUM(total_amount) as total_revenue
-        FROM orders
-    ''').fetchone()
+    stats = get_order_status_counts(conn)
     
     conn.close()
     
@@ -1560,27 +4182,51 @@ def admin_order_detail(order_id):
         JOIN products p ON oi.product_id = p.id
         WHERE oi.order_id = ?
     ''', (order_id,)).fetchall()
+    timeline = get_order_timelines(conn, [order_id])[order_id]
     
     conn.close()
-    return render_template('admin/order_detail.html', order=order, order_items=order_items)
+    return render_template('admin/order_detail.html', order=order, order_items=order_items,
+                           timeline=timeline)
 
 @app.route('/admin/update_order_status', methods=['POST'])
 @admin_required
 def update_order_status():
-    order_id = request.form['order_id']
+    order_id = request.form.get('order_id', type=int)
     new_status = request.form['status']
     
     try:
         conn = get_db_connection()
-        conn.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
-        conn.commit()
-        conn.close()
+        try:
+            if new_status == 'cancelled':
+                # Same guarded path as customer cancellation, so stock comes back exactly once
+                product_ids = cancel_pending_order(conn, order_id, 'Cancelled by admin', session['user_id'])
+                updated = product_ids is not None
+            else:
+                product_ids = []
+                updated = transition_order(conn, order_id, new_status, actor_id=session['user_id']) is not None
+                conn.commit()
+        finally:
+            conn.close()
+        
+        for product_id in product_ids or []:
+            invalidate_product(product_id)
+        if product_ids:
+            refresh_facets(product_ids)
+            update_featured_products(product_ids)
+        
+        if not updated:
+            message = f'An order cannot move to {new_status.title()} from its current status.'
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'success': False, 'error': message}), 409
+            flash(message, 'warning')
+            return redirect(url_for('admin_order_detail', order_id=order_id))
         
         # Check if it's an AJAX request
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({
                 'success': True,
                 'new_status': new_status,
+                'next_statuses': list(next_order_statuses(new_status)),
                 'message': f'Order status updated to {new_status.title()}!'
             })
         else:
@@ -1597,6 +4243,92 @@ def update_order_status():
             flash('Error updating order status. Please try again.', 'error')
             return redirect(url_for('admin_order_detail', order_id=order_id))
 
+@app.route('/admin/orders/bulk_status', methods=['POST'])
+@admin_required
+def bulk_update_order_status():
+    """Apply one status transition to the listed orders, or to every eligible order matching the admin filters"""
+    wants_json = request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        raw_ids = data.get('order_ids') or []
+        order_filter = data.get('filter')
+    else:
+        data = request.form
+        raw_ids = request.form.getlist('order_ids')
+        order_filter = None
+        if request.form.get('apply_to') == 'filter':
+            order_filter = {'status': request.form.get('filter_status', ''),
+                            'search': request.form.get('filter_search', '')}
+    new_status = data.get('status')
+    note = data.get('note') or None
+    sources = [status for status, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    
+    conn = get_db_connection()
+    try:
+        if order_filter is not None:
+            # Only orders the move is allowed from, so "ship everything processing" is one request
+            where_clause, params = order_filter_clause(order_filter.get('status', ''), order_filter.get('search', ''))
+            where_clause += (' AND ' if where_clause else ' WHERE ') + f"o.status IN ({','.join('?' * len(sources))})"
+            order_ids = [row['id'] for row in conn.execute('''
+                SELECT o.id FROM orders o
+                JOIN users u ON o.user_id = u.id
+            ''' + where_clause + ' ORDER BY o.id LIMIT ?', params + sources + [ORDER_BULK_LIMIT + 1])]
+        else:
+            order_ids = list(dict.fromkeys(int(order_id) for order_id in raw_ids if str(order_id).isdigit()))
+        
+        error = None
+        if not sources:
+            error = 'No order can be moved to that status.'
+        elif not order_ids:
+            error = 'No matching orders to update.'
+        elif len(order_ids) > ORDER_BULK_LIMIT:
+            error = f'At most {ORDER_BULK_LIMIT} orders can be updated at once. Please narrow the filter.'
+        if error:
+            if wants_json:
+                return jsonify({'success': False, 'error': error}), 400
+            flash(error, 'warning')
+            return redirect(url_for('admin_orders'))
+        
+        results = []
+        product_ids = set()
+        for start in range(0, len(order_ids), ORDER_BULK_BATCH):
+            chunk = order_ids[start:start + ORDER_BULK_BATCH]
+            moved = transition_orders(conn, chunk, new_status, note, session['user_id'])
+            if new_status == 'cancelled':
+                product_ids.update(order_product_ids(conn, moved))
+            conn.commit()
+            
+            refused = [order_id for order_id in chunk if order_id not in moved]
+            current = {}
+            if refused:
+                current = {row['id']: row['status'] for row in conn.execute(f'''
+                    SELECT id, status FROM orders WHERE id IN ({','.join('?' * len(refused))})
+                ''', refused)}
+            for order_id in chunk:
+                if order_id in moved:
+                    results.append({'order_id': order_id, 'success': True, 'from_status': moved[order_id]})
+                elif order_id in current:
+                    results.append({'order_id': order_id, 'success': False,
+                                    'error': f'Cannot move from {current[order_id].title()}'})
+                else:
+                    results.append({'order_id': order_id, 'success': False, 'error': 'Order not found'})
+    finally:
+        conn.close()
+    
+    for product_id in product_ids:
+        invalidate_product(product_id)
+    if product_ids:
+        refresh_facets(list(product_ids))
+        update_featured_products(list(product_ids))
+    
+    updated = sum(1 for result in results if result['success'])
+    message = f'{updated} of {len(results)} orders moved to {new_status.title()}.'
+    if wants_json:
+        return jsonify({'success': True, 'status': new_status, 'updated': updated,
+                        'failed': len(results) - updated, 'message': message, 'results': results})
+    flash(message, 'success' if updated == len(results) else 'warning')
+    return redirect(url_for('admin_orders'))
+
 @app.route('/admin/categories')
 @admin_required
 def admin_categories():
@@ -1605,6 +4337,13 @@ def admin_categories():
     conn.close()
     return render_template('admin/categories.html', categories=categories)
 
+def parse_gst_rate(value):
+    """Form value for a category slab: '' keeps the default rate, otherwise one of GST_SLABS"""
+    if not value:
+        return None
+    rate = float(value)
+    return rate if rate in GST_SLABS else None
+
 @app.route('/admin/add_category', methods=['GET', 'POST'])
 @admin_required
 def admin_add_category():
@@ -1612,20 +4351,24 @@ def admin_add_category():
         name = request.form['name']
         description = request.form['description']
         image_url = request.form.get('image_url', '')
+        gst_rate = parse_gst_rate(request.form.get('gst_rate'))
         
         conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO categories (name, description, image_url)
-            VALUES (?, ?, ?)
-        ''', (name, description, image_url))
+        cursor = conn.execute('''
+            INSERT INTO categories (name, description, image_url, gst_rate)
+            VALUES (?, ?, ?, ?)
+        ''', (name, description, image_url, gst_rate))
         
         conn.commit()
         conn.close()
+        invalidate_categories()
+        if search_index is not None:
+            search_index.add('category', cursor.lastrowid, name)
         
         flash('Category added successfully!', 'success')
         return redirect(url_for('admin_categories'))
     
-    return render_template('admin/add_category.html')
+    return render_template('admin/add_category.html', gst_slabs=GST_SLABS, default_gst_rate=GST_RATE)
 
 @app.route('/admin/edit_category/<int:category_id>', methods=['GET', 'POST'])
 @admin_required
@@ -1636,16 +4379,30 @@ def admin_edit_category(category_id):
         name = request.form['name']
         description = request.form['description']
         image_url = request.form.get('image_url', '')
+        gst_rate = parse_gst_rate(request.form.get('gst_rate'))
         
+        old_rules = get_pricing_rules()
         conn.execute('''
-            UPDATE categories SET name = ?, description = ?, image_url = ?
+            UPDATE categories SET name = ?, description = ?, image_url = ?,
+                   gst_rate = CASE WHEN ? THEN ? ELSE gst_rate END
             WHERE id = ?
-        ''', (name, description, image_url, category_id))
+        ''', (name, description, image_url, 'gst_rate' in request.form, gst_rate, category_id))
         
         conn.commit()
-        conn.close()
+        invalidate_categories()
+        if search_index is not None:
+            search_index.add('category', category_id, name)
         
         flash('Category updated successfully!', 'success')
+        new_rules = get_pricing_rules()
+        if new_rules.gst_rate(category_id) != old_rules.gst_rate(category_id):
+            # Re-quote every open cart against both rule sets to show the impact
+            before = quote_open_carts(conn, old_rules)
+            after = quote_open_carts(conn, new_rules)
+            changed = sum(1 for user_id in after if after[user_id]['gst'] != before[user_id]['gst'])
+            gst_delta = sum(quote['gst'] for quote in after.values()) - sum(quote['gst'] for quote in before.values())
+            flash(f'GST change re-quoted {changed} open carts ({format_inr(gst_delta)} GST in total).', 'info')
+        conn.close()
         return redirect(url_for('admin_categories'))
     
     category = conn.execute('SELECT * FROM categories WHERE id = ?', (category_id,)).fetchone()
@@ -1655,7 +4412,8 @@ def admin_edit_category(category_id):
         flash('Category not found.', 'danger')
         return redirect(url_for('admin_categories'))
     
-    return render_template('admin/edit_category.html', category=category)
+    return render_template('admin/edit_category.html', category=category,
+                           gst_slabs=GST_SLABS, default_gst_rate=GST_RATE)
 
 @app.route('/admin/delete_category/<int:category_id>', methods=['POST'])
 @admin_required
@@ -1670,11 +4428,81 @@ def admin_delete_category(category_id):
     else:
         conn.execute('DELETE FROM categories WHERE id = ?', (category_id,))
         conn.commit()
+        invalidate_categories()
+        if search_index is not None:
+            search_index.remove('category', category_id)
         flash('Category deleted successfully!', 'success')
     
     conn.close()
     return redirect(url_for('admin_categories'))
 
+def parse_form_datetime(value):
+    """datetime-local input ('2024-05-01T09:30') to SQLite's 'YYYY-MM-DD HH:MM:SS'"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M').strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/admin/promotions', methods=['GET', 'POST'])
+@admin_required
+def admin_promotions():
+    conn = get_db_connection()
+    
+    if request.method == 'POST':
+        code = normalize_coupon_code(request.form.get('code'))
+        description = request.form['description'].strip()
+        kind = request.form.get('kind')
+        value = request.form.get('value', type=float)
+        scope = request.form.get('scope', 'cart')
+        scope_id = request.form.get(f'{scope}_id', type=int) if scope in ('category', 'product') else None
+        min_cart_amount = request.form.get('min_cart_amount', type=float) or 0
+        max_redemptions = request.form.get('max_redemptions', type=int)
+        starts_at = parse_form_datetime(request.form.get('starts_at'))
+        ends_at = parse_form_datetime(request.form.get('ends_at'))
+        
+        if (not description or kind not in ('percent', 'flat') or not value or value <= 0
+                or (kind == 'percent' and value > 100)
+                or scope not in ('cart', 'category', 'product')
+                or (scope != 'cart' and not scope_id)):
+            flash('Please check the promotion details.', 'danger')
+        else:
+            try:
+                conn.execute('''
+                    INSERT INTO promotions (code, description, kind, value, scope, scope_id,
+                                            min_cart_amount, max_redemptions, starts_at, ends_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (code, description, kind, value, scope, scope_id,
+                      min_cart_amount, max_redemptions, starts_at, ends_at))
+                conn.commit()
+                invalidate_promotions()
+                flash('Promotion created successfully!', 'success')
+            except sqlite3.IntegrityError:
+                flash('A promotion with that code already exists.', 'danger')
+        conn.close()
+        return redirect(url_for('admin_promotions'))
+    
+    promotions = conn.execute('''
+        SELECT pr.*, c.name as category_name, p.name as product_name
+        FROM promotions pr
+        LEFT JOIN categories c ON pr.scope = 'category' AND c.id = pr.scope_id
+        LEFT JOIN products p ON pr.scope = 'product' AND p.id = pr.scope_id
+        ORDER BY pr.created_at DESC, pr.id DESC
+    ''').fetchall()
+    products = conn.execute('SELECT id, name FROM products WHERE is_active = 1 ORDER BY name').fetchall()
+    conn.close()
+    
+    return render_template('admin/promotions.html', promotions=promotions, products=products)
+
+@app.route('/admin/promotions/<int:promotion_id>/toggle', methods=['POST'])
+@admin_required
+def admin_toggle_promotion(promotion_id):
+    conn = get_db_connection()
+    conn.execute('UPDATE promotions SET is_active = NOT is_active WHERE id = ?', (promotion_id,))
+    conn.commit()
+    conn.close()
+    invalidate_promotions()
+    flash('Promotion updated.', 'success')
+    return redirect(url_for('admin_promotions'))
+
 @app.route('/admin/edit_product/<int:product_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_product(product_id):
@@ -1693,7 +4521,9 @@ def admin_edit_product(product_id):
         is_active = 1 if request.form.get('is_active') else 0
         
         # Get current product to preserve existing image if no new one uploaded
-        current_product = conn.execute('SELECT image_url FROM products WHERE id = ?', (product_id,)).fetchone()
+        current_product = conn.execute('''
+            SELECT image_url, category_id, average_rating, total_reviews FROM products WHERE id = ?
+        ''', (product_id,)).fetchone()
         image_url = current_product['image_url'] if current_product else '/static/images/default-product.jpg'
         
         # Handle image upload or URL
@@ -1722,6 +4552,12 @@ def admin_edit_product(product_id):
         
         conn.commit()
         conn.close()
+        invalidate_product(product_id, category_id,
+                           current_product['category_id'] if current_product else None)
+        index_product_for_search(product_id, name, is_active,
+                                 product_search_weight(current_product) if current_product else 0)
+        refresh_facets([product_id])
+        update_featured_products([product_id])
         
         flash('Product updated successfully!', 'success')
         return redirect(url_for('admin_products'))
@@ -1743,6 +4579,10 @@ def admin_delete_product(product_id):
     conn.execute('UPDATE products SET is_active = 0 WHERE id = ?', (product_id,))
     conn.commit()
     conn.close()
+    invalidate_product(product_id)
+    index_product_for_search(product_id, None, is_active=False)
+    refresh_facets([product_id])
+    update_featured_products([product_id])
     
     flash('Product deactivated successfully!', 'success')
     return redirect(url_for('admin_products'))
@@ -1755,6 +4595,10 @@ def admin_delete_product_api(product_id):
         conn.execute('UPDATE products SET is_active = 0 WHERE id = ?', (product_id,))
         conn.commit()
         conn.close()
+        invalidate_product(product_id)
+        index_product_for_search(product_id, None, is_active=False)
+        refresh_facets([product_id])
+        update_featured_products([product_id])
         
         return jsonify({'success': True, 'message': 'Product deleted successfully'})
     except Exception as e:
@@ -1794,14 +4638,40 @@ def admin_analytics():
     ''').fetchall()
     
     # Order status distribution
-    order_stats = conn.execute('''
+    order_stats = get_order_status_counts(conn)['by_status']
+    
+    # Most viewed products over the last 30 days (flushed views only)
+    view_products = conn.execute('''
         SELECT 
-            status,
-            COUNT(*) as count
-        FROM orders
-        GROUP BY status
+            p.name,
+            SUM(v.views) as views
+        FROM product_view_days v
+        JOIN products p ON v.product_id = p.id
+        WHERE v.day >= date('now', '-30 days')
+        GROUP BY p.id, p.name
+        ORDER BY views DESC
+        LIMIT 10
     ''').fetchall()
     
+    # Abandoned carts: lines expired in the last 30 days and lines about to expire
+    abandoned_carts = conn.execute('''
+        SELECT 
+            COALESCE(SUM(lines), 0) as lines,
+            COALESCE(SUM(quantity), 0) as quantity,
+            COALESCE(SUM(value), 0) as value
+        FROM abandoned_cart_days
+        WHERE day >= date('now', '-30 days')
+    ''').fetchone()
+    idle_carts = conn.execute('''
+        SELECT 
+            COUNT(DISTINCT c.user_id) as carts,
+            COUNT(*) as lines,
+            COALESCE(SUM(c.quantity * p.price), 0) as value
+        FROM cart c
+        JOIN products p ON c.product_id = p.id
+        WHERE c.updated_at < datetime('now', ?)
+    ''', (f'-{CART_IDLE_DAYS} days',)).fetchone()
+    
     # User registration trends
     user_stats = conn.execute('''
         SELECT 
@@ -1819,6 +4689,11 @@ def admin_analytics():
     return render_template('admin/analytics.html', 
                          monthly_sales=monthly_sales,
                          top_products=top_products,
+                         view_products=view_products,
+                         abandoned_carts=abandoned_carts,
+                         idle_carts=idle_carts,
+                         cart_ttl_days=CART_TTL_DAYS,
+                         cart_idle_days=CART_IDLE_DAYS,
                          order_stats=order_stats,
                          user_stats=user_stats)
 
@@ -1827,6 +4702,154 @@ def admin_analytics():
 def admin_settings():
     return render_template('admin/settings.html')
 
+# Admin exports
+EXPORT_BATCH_SIZE = 1000  # rows per short read while streaming an export
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+EXPORT_DATASETS = {
+    'orders': {
+        'query': '''
+            SELECT o.id, o.user_id, u.email, u.full_name, o.status, o.total_amount, o.discount_amount,
+                   o.promotion_id, o.payment_method, o.payment_status, o.tracking_number,
+                   o.city, o.state, o.postal_code, o.estimated_delivery, o.delivered_at, o.created_at
+            FROM orders o
+            JOIN users u ON o.user_id = u.id
+        ''',
+        'key': 'o.id', 'date': 'o.created_at', 'status': 'o.status',
+    },
+    'order_items': {
+        'query': '''
+            SELECT oi.id, oi.order_id, o.status, o.created_at as order_created_at,
+                   oi.product_id, p.name as product_name, oi.quantity, oi.price,
+                   oi.quantity * oi.price as line_total
+            FROM order_items oi
+            JOIN orders o ON oi.order_id = o.id
+            LEFT JOIN products p ON oi.product_id = p.id
+        ''',
+        'key': 'oi.id', 'date': 'o.created_at', 'status': 'o.status',
+    },
+    'products': {
+        'query': '''
+            SELECT p.id, p.name, c.name as category, p.price, p.stock_quantity, p.is_active,
+                   p.image_url, p.description, p.detailed_description, p.benefits,
+                   p.usage_instructions, p.warnings
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+        ''',
+        'key': 'p.id', 'date': 'p.created_at',
+        'status': "CASE WHEN p.is_active THEN 'active' ELSE 'inactive' END",
+    },
+    'users': {
+        'query': '''
+            SELECT u.id, u.username, u.email, u.full_name, u.phone, u.city, u.state,
+                   u.postal_code, u.role, u.is_active, u.created_at
+            FROM users u
+        ''',
+        'key': 'u.id', 'date': 'u.created_at',
+        'status': "CASE WHEN u.is_active THEN 'active' ELSE 'inactive' END",
+    },
+}
+
+def parse_export_date(value):
+    """YYYY-MM-DD from the export form, or None; raises ValueError for anything else"""
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') if value else None
+
+def export_rows(dataset, conditions, params, fmt):
+    """Yield an export as CSV or JSON Lines text, one chunk per batch of rows.
+
+    Rows are read by keyset pagination on the dataset key, so every batch
+    is its own short query: no read transaction stays open while the
+    client downloads, and writers are never locked out by an export.
+    """
+    spec = EXPORT_DATASETS[dataset]
+    where_clause = ' AND '.join([f"{spec['key']} > ?"] + conditions)
+    query = f"{spec['query']} WHERE {where_clause} ORDER BY {spec['key']} LIMIT ?"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    last_key = 0
+    header_written = False
+    conn = get_db_connection()
+    try:
+        while True:
+            cursor = conn.execute(query, [last_key, *params, EXPORT_BATCH_SIZE])
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            cursor.close()
+            if fmt == 'csv' and not header_written:
+                writer.writerow(columns)
+                header_written = True
+            for row in rows:
+                if fmt == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+            if buffer.tell():
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if len(rows) < EXPORT_BATCH_SIZE:
+                break
+            last_key = rows[-1]['id']
+    finally:
+        conn.close()
+
+@app.route('/admin/export/<dataset>')
+@admin_required
+def admin_export(dataset):
+    """Stream orders, order items, products or users as a CSV or JSONL download, filtered by date range and status"""
+    fmt = request.args.get('format', 'csv')
+    if dataset not in EXPORT_DATASETS or fmt not in EXPORT_FORMATS:
+        flash('Unknown export.', 'danger')
+        return redirect(url_for('admin_analytics'))
+    try:
+        date_from = parse_export_date(request.args.get('from'))
+        date_to = parse_export_date(request.args.get('to'))
+    except ValueError:
+        flash('Export dates must be in YYYY-MM-DD format.', 'danger')
+        return redirect(url_for('admin_analytics'))
+    
+    spec = EXPORT_DATASETS[dataset]
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append(f"{spec['date']} >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append(f"{spec['date']} < date(?, '+1 day')")
+        params.append(date_to)
+    status = request.args.get('status')
+    if status:
+        conditions.append(f"{spec['status']} = ?")
+        params.append(status)
+    
+    filename = secure_filename('_'.join(filter(None, [dataset, status, date_from, date_to])) + f'.{fmt}')
+    return Response(export_rows(dataset, conditions, params, fmt),
+                    mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.cli.command('refresh-featured')
+def refresh_featured_command():
+    """Recompute the home page featured ranking; run from cron so the sales window rolls"""
+    ranked = refresh_featured_products()
+    print(f'Ranked {ranked} featured products.')
+
+@app.cli.command('expire-carts')
+def expire_carts_command():
+    """Drop cart lines idle for longer than CART_TTL_DAYS; safe to run from cron while serving"""
+    expired = expire_abandoned_carts()
+    print(f'Expired {expired} abandoned cart lines. '
+          f'Cart counters on running servers catch up within {PERSONAL_STATE_TTL}s.')
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    """Rebuild the frequently-bought-together index from all past orders"""
+    conn = get_db_connection()
+    products_indexed = rebuild_recommendations(conn)
+    conn.close()
+    invalidate_recommendations()  # running servers pick this up from catalog_changes
+    print(f'Rebuilt recommendations for {products_indexed} products.')
+
 if __name__ == '__main__':
     init_db()
+    build_search_index()
+    build_facet_index()
     app.run(debug=True, host='0.0.0.0', port=5000)
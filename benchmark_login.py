@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Login throughput benchmark for MediPlant
+- Runs concurrent logins against a throwaway database for each hash setting
+- Reports logins per second and latency, plus catalog latency under the login load
+- Use it to pick PASSWORD_HASH_METHOD / PASSWORD_HASH_WORKERS for the hardware
+
+    python benchmark_login.py
+    python benchmark_login.py --methods pbkdf2:sha256:600000 scrypt:16384:8:1 --workers 1 2 4
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.security import generate_password_hash
+
+DEFAULT_METHODS = ['pbkdf2:sha256:260000', 'pbkdf2:sha256:600000', 'scrypt:16384:8:1', 'scrypt:32768:8:1']
+USERNAME = 'benchuser'
+PASSWORD = 'bench-password'
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_setting(webapp, method, workers, concurrency, seconds):
+    """Log in from `concurrency` threads for `seconds` while one thread browses the catalog"""
+    webapp.app.config['PASSWORD_HASH_METHOD'] = method
+    webapp.app.config['PASSWORD_HASH_WORKERS'] = workers
+    webapp.password_hash_pool = None  # rebuilt with the new worker count on first use
+
+    # Store the hash in the benchmarked format so no login triggers a rehash
+    conn = webapp.get_db_connection()
+    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?',
+                 (generate_password_hash(PASSWORD, method), USERNAME))
+    conn.commit()
+    conn.close()
+
+    login_times = []
+    catalog_times = []
+    failures = []
+    deadline = time.perf_counter() + seconds
+
+    def log_in():
+        client = webapp.app.test_client()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+            login_times.append(time.perf_counter() - started)
+            if response.status_code != 302:
+                failures.append(response.status_code)
+            client.get('/logout')
+
+    def browse():
+        client = webapp.app.test_client()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            client.get('/products')
+            catalog_times.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=log_in) for _ in range(concurrency)]
+    threads.append(threading.Thread(target=browse))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'logins_per_second': len(login_times) / seconds,
+        'login_p50': statistics.median(login_times) if login_times else 0,
+        'login_p95': percentile(login_times, 0.95),
+        'catalog_p95': percentile(catalog_times, 0.95),
+        'rejected': len(failures),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark login throughput per password hash setting')
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS,
+                        help='werkzeug hash methods, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000')
+    parser.add_argument('--workers', nargs='+', type=int, default=[2],
+                        help='PASSWORD_HASH_WORKERS values to try')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent login threads')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each run')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix='mediplant-bench-')
+    os.chdir(workdir)
+    import app as webapp
+    webapp.DATABASE = os.path.join(workdir, 'mediplant.db')
+    # Every login is the same user from the same address; measure hashing, not the rate limiter
+    webapp.app.config['RATE_LIMITS'] = {}
+    webapp.init_db()
+    conn = webapp.get_db_connection()
+    conn.execute('''
+        INSERT INTO users (username, email, password_hash, full_name)
+        VALUES (?, ?, '', 'Benchmark User')
+    ''', (USERNAME, f'{USERNAME}@example.com'))
+    conn.commit()
+    conn.close()
+
+    print(f"Login benchmark: {args.concurrency} login threads + 1 catalog thread, {args.seconds:g}s per run")
+    print(f"{'method':<24} {'workers':>7} {'logins/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'catalog p95 ms':>15} {'rejected':>9}")
+    try:
+        for method in args.methods:
+            for workers in args.workers:
+                result = run_setting(webapp, method, workers, args.concurrency, args.seconds)
+                print(f"{method:<24} {workers:>7} {result['logins_per_second']:>9.1f} "
+                      f"{result['login_p50'] * 1000:>8.1f} {result['login_p95'] * 1000:>8.1f} "
+                      f"{result['catalog_p95'] * 1000:>15.1f} {result['rejected']:>9}")
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -357,6 +357,16 @@ def create_sample_data():
             ''', (order['user_id'], order['total_amount'], order['status'], order['address'],
                   order['created_at']))
         
+        # Keep the app's order status counters in step with the new orders
+        try:
+            conn.execute('DELETE FROM order_status_counts')
+            conn.execute('''
+                INSERT INTO order_status_counts (status, orders, revenue)
+                SELECT status, COUNT(*), COALESCE(SUM(total_amount), 0) FROM orders GROUP BY status
+            ''')
+        except sqlite3.OperationalError:
+            pass  # Table is created by the app's init_db
+        
         print("✅ Created sample orders")
         
         conn.commit()
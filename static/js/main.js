@@ -7,6 +7,10 @@ document.addEventListener('DOMContentLoaded', function() {
     initializeTooltips();
     initializeImageLazyLoading();
     initializeFormValidation();
+    loadSessionState();
+    initializeReviewPaging();
+    initializeSearchSuggestions();
+    loadRecentlyViewed();
     
     // Auto-hide flash messages
     setTimeout(function() {
@@ -68,21 +72,91 @@ function updateCartQuantity(input) {
     const quantity = parseInt(input.value);
     
     if (cartItemId) {
-        // Here you can add AJAX call to update cart quantity
-        console.log(`Updating cart item ${cartItemId} to quantity ${quantity}`);
-        
-        // Show loading state
         input.classList.add('loading');
         
-        // Simulate API call
-        setTimeout(function() {
-            input.classList.remove('loading');
-            showToast('Cart updated successfully!', 'success');
-            updateCartTotal();
-        }, 500);
+        fetch('/update_cart_quantity', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'X-Requested-With': 'XMLHttpRequest'
+            },
+            body: `cart_id=${cartItemId}&quantity=${quantity}`
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                const priceElement = input.closest('.cart-item').querySelector('.item-price');
+                if (priceElement) {
+                    priceElement.textContent = formatINR(data.new_subtotal);
+                }
+                applyCartTotals(data.cart);
+                showToast(data.message, 'success');
+            } else {
+                showToast(data.message, 'danger');
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showToast('Error updating quantity', 'danger');
+        })
+        .finally(() => input.classList.remove('loading'));
+    }
+}
+
+// Apply server-computed cart totals (GST, shipping, counter). Each cart write
+// returns a version, so a slow response never overwrites a newer one.
+let cartVersion = 0;
+
+function applyCartTotals(cart) {
+    if (!cart) {
+        return;
+    }
+    const summary = document.querySelector('.cart-summary');
+    const shownVersion = Math.max(cartVersion, summary ? parseInt(summary.dataset.cartVersion) || 0 : 0);
+    if (cart.version < shownVersion) {
+        return;
+    }
+    cartVersion = cart.version;
+    
+    setCartCounter(cart.quantity);
+    if (!summary) {
+        return;
+    }
+    summary.dataset.cartVersion = cart.version;
+    
+    const setText = (selector, text) => {
+        const element = summary.querySelector(selector);
+        if (element) element.textContent = text;
+    };
+    setText('.cart-item-count', cart.items);
+    setText('.cart-subtotal', formatINR(cart.subtotal));
+    setText('.tax-amount', formatINR(cart.gst));
+    setText('.cart-total', formatINR(cart.total));
+    
+    const discountRow = summary.querySelector('.discount-row');
+    if (discountRow) {
+        discountRow.classList.toggle('d-none', !cart.discount);
+        setText('.discount-label', cart.promotion ? cart.promotion.description : '');
+        setText('.discount-amount', `-${formatINR(cart.discount)}`);
+    }
+    
+    const shippingElement = summary.querySelector('.shipping-amount');
+    if (shippingElement) {
+        shippingElement.innerHTML = cart.shipping === 0 ? '<span class="text-success">FREE</span>' : formatINR(cart.shipping);
+    }
+    
+    const freeShippingBanner = summary.querySelector('.free-shipping-banner');
+    if (freeShippingBanner) {
+        const remaining = cart.free_shipping_threshold - cart.subtotal;
+        freeShippingBanner.classList.toggle('d-none', remaining <= 0);
+        setText('.free-shipping-remaining', formatINR(Math.max(remaining, 0)));
     }
 }
 
+function formatINR(amount) {
+    return `₹${amount.toLocaleString('en-IN', {minimumFractionDigits: 2, maximumFractionDigits: 2})}`;
+}
+
 // Animation Initialization
 function initializeAnimations() {
     // Scroll animations
@@ -148,31 +222,116 @@ function initializeFormValidation() {
     });
 }
 
+// Recently viewed strip; loaded separately so catalog pages can stay cached
+function loadRecentlyViewed() {
+    const section = document.getElementById('recentlyViewed');
+    if (!section) {
+        return;
+    }
+    
+    const params = section.dataset.exclude ? `?exclude=${section.dataset.exclude}` : '';
+    fetch(`/recently_viewed${params}`, {
+        headers: {'X-Requested-With': 'XMLHttpRequest'}
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.count > 0) {
+            section.firstElementChild.innerHTML = data.html;
+            section.classList.remove('d-none');
+        }
+    })
+    .catch(error => console.error('Error loading recently viewed:', error));
+}
+
+// Review paging on product detail: "load more" and sort selector
+function initializeReviewPaging() {
+    const reviewList = document.getElementById('reviewList');
+    const loadMoreButton = document.getElementById('loadMoreReviews');
+    const sortSelect = document.getElementById('reviewSort');
+    
+    if (!reviewList || !loadMoreButton) {
+        return;
+    }
+    
+    function loadReviews(append) {
+        const params = new URLSearchParams({sort: sortSelect ? sortSelect.value : 'newest'});
+        if (append && loadMoreButton.dataset.nextCursor) {
+            params.set('after', loadMoreButton.dataset.nextCursor);
+        }
+        
+        showLoading(loadMoreButton);
+        fetch(`/product/${reviewList.dataset.productId}/reviews?${params}`, {
+            headers: {'X-Requested-With': 'XMLHttpRequest'}
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                showToast(data.message, 'warning');
+                return;
+            }
+            if (append) {
+                reviewList.insertAdjacentHTML('beforeend', data.html);
+            } else {
+                reviewList.innerHTML = data.html;
+            }
+            loadMoreButton.dataset.nextCursor = data.next_cursor || '';
+            loadMoreButton.classList.toggle('d-none', !data.next_cursor);
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showToast('Error loading reviews', 'danger');
+        })
+        .finally(() => hideLoading(loadMoreButton));
+    }
+    
+    loadMoreButton.addEventListener('click', function() {
+        loadReviews(true);
+    });
+    
+    if (sortSelect) {
+        sortSelect.addEventListener('change', function() {
+            loadReviews(false);
+        });
+    }
+}
+
 // Add to cart functionality
 function addToCart(productId, quantity = 1) {
-    const formData = new FormData();
-    formData.append('product_id', productId);
-    formData.append('quantity', quantity);
-    
-    // Show loading state
-    const addButton = document.querySelector(`[onclick*="${productId}"]`);
+    const addButton = document.querySelector(`[onclick*="addToCart(${productId})"]`);
+    const originalText = addButton ? addButton.innerHTML : '';
     if (addButton) {
-        const originalText = addButton.innerHTML;
-        addButton.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Adding...';
+        addButton.innerHTML = '<i class="fas fa-spinner fa-spin"></i>';
         addButton.disabled = true;
-        
-        // Simulate API call
-        setTimeout(function() {
-            addButton.innerHTML = '<i class="fas fa-check"></i> Added!';
-            setTimeout(function() {
-                addButton.innerHTML = originalText;
-                addButton.disabled = false;
-            }, 2000);
-        }, 1000);
     }
     
-    showToast('Product added to cart!', 'success');
-    updateCartCounter();
+    fetch('/add_to_cart', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'X-Requested-With': 'XMLHttpRequest'
+        },
+        body: `product_id=${productId}&quantity=${quantity}`
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            markInCart(productId);
+            showToast(data.message, 'success');
+            updateCartCounter();
+        } else {
+            showToast(data.message, 'warning');
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showToast('Error adding to cart', 'danger');
+    })
+    .finally(() => {
+        if (addButton) {
+            addButton.innerHTML = addButton.classList.contains('btn-success') ? '<i class="fas fa-check"></i>' : originalText;
+            addButton.disabled = false;
+        }
+    });
 }
 
 // Add to wishlist functionality
@@ -237,19 +396,82 @@ function updateCartTotal() {
     }
 }
 
-// Update cart counter in navigation
-function updateCartCounter() {
+// Fill in the personalized parts of cached pages (username, cart counter, wishlist hearts)
+function loadSessionState() {
+    if (!document.body.dataset.personalize) {
+        return;
+    }
+    
+    fetch('/session_state', {
+        headers: {'X-Requested-With': 'XMLHttpRequest'}
+    })
+    .then(response => response.json())
+    .then(data => {
+        setCartCounter(data.cart_count);
+        data.cart_product_ids.forEach(markInCart);
+        
+        if (!data.logged_in) {
+            return;
+        }
+        
+        document.querySelectorAll('.nav-username').forEach(function(element) {
+            element.textContent = data.username;
+        });
+        
+        data.wishlist_product_ids.forEach(function(productId) {
+            document.querySelectorAll(`[data-wishlist-product-id="${productId}"]`).forEach(function(button) {
+                const icon = button.querySelector('i');
+                if (icon) {
+                    icon.classList.remove('far');
+                    icon.classList.add('fas');
+                }
+                button.classList.add('text-danger');
+            });
+        });
+    })
+    .catch(error => console.error('Error loading session state:', error));
+}
+
+function markInCart(productId) {
+    document.querySelectorAll(`[data-cart-product-id="${productId}"]`).forEach(function(button) {
+        button.classList.remove('btn-primary');
+        button.classList.add('btn-success');
+        button.title = 'In Cart';
+        const icon = button.querySelector('i');
+        if (icon) {
+            icon.classList.remove('fa-cart-plus');
+            icon.classList.add('fa-check');
+        }
+    });
+}
+
+function setCartCounter(count) {
     const counter = document.querySelector('.cart-counter');
     if (counter) {
-        let count = parseInt(counter.textContent) || 0;
-        counter.textContent = count + 1;
+        counter.textContent = count;
+        counter.classList.toggle('d-none', !count);
+    }
+}
+
+// Update cart counter in navigation
+function updateCartCounter() {
+    fetch('/cart_summary', {
+        headers: {'X-Requested-With': 'XMLHttpRequest'}
+    })
+    .then(response => response.json())
+    .then(data => {
+        setCartCounter(data.quantity);
         
         // Animate counter
-        counter.classList.add('animate-pulse');
-        setTimeout(function() {
-            counter.classList.remove('animate-pulse');
-        }, 1000);
-    }
+        const counter = document.querySelector('.cart-counter');
+        if (counter) {
+            counter.classList.add('animate-pulse');
+            setTimeout(function() {
+                counter.classList.remove('animate-pulse');
+            }, 1000);
+        }
+    })
+    .catch(error => console.error('Error updating cart counter:', error));
 }
 
 // Toast notification system
@@ -314,22 +536,88 @@ function performSearch() {
     }
 }
 
-// Filter products
-function filterProducts(category) {
-    const currentUrl = new URL(window.location.href);
-    currentUrl.searchParams.set('category', category);
-    window.location.href = currentUrl.toString();
+// Typeahead suggestions for the nav search box, debounced so fast typing sends one request
+function initializeSearchSuggestions() {
+    const searchInput = document.querySelector('input[name="search"]');
+    if (!searchInput) {
+        return;
+    }
+    
+    let debounceTimer = null;
+    let latestQuery = '';
+    
+    searchInput.setAttribute('autocomplete', 'off');
+    searchInput.addEventListener('input', function() {
+        clearTimeout(debounceTimer);
+        const query = this.value.trim();
+        latestQuery = query;
+        
+        if (query.length < 2) {
+            removeSearchSuggestions();
+            return;
+        }
+        
+        debounceTimer = setTimeout(function() {
+            fetch(`/search_suggestions?q=${encodeURIComponent(query)}`)
+            .then(response => response.json())
+            .then(data => {
+                // Ignore responses that arrive after the user kept typing
+                if (query === latestQuery) {
+                    displaySearchSuggestions(data, searchInput);
+                }
+            })
+            .catch(error => console.error('Error loading suggestions:', error));
+        }, 150);
+    });
+    
+    // Hide suggestions when clicking outside
+    document.addEventListener('click', function(e) {
+        if (!searchInput.parentNode.contains(e.target)) {
+            removeSearchSuggestions();
+        }
+    });
+}
+
+function removeSearchSuggestions() {
+    const existingSuggestions = document.querySelector('.search-suggestions');
+    if (existingSuggestions) {
+        existingSuggestions.remove();
+    }
 }
 
-// Price range filter
-function updatePriceRange() {
-    const minPrice = document.querySelector('#minPrice').value;
-    const maxPrice = document.querySelector('#maxPrice').value;
+function displaySearchSuggestions(data, input) {
+    removeSearchSuggestions();
     
-    const currentUrl = new URL(window.location.href);
-    if (minPrice) currentUrl.searchParams.set('min_price', minPrice);
-    if (maxPrice) currentUrl.searchParams.set('max_price', maxPrice);
+    const entries = data.products.map(item => ({item: item, icon: 'fa-seedling'}))
+        .concat(data.categories.map(item => ({item: item, icon: 'fa-th-large'})));
+    if (entries.length === 0) {
+        return;
+    }
+    
+    const suggestionsDiv = document.createElement('div');
+    suggestionsDiv.className = 'search-suggestions position-absolute bg-white border rounded shadow-sm';
+    suggestionsDiv.style.cssText = 'top: 100%; left: 0; right: 0; z-index: 1000; max-height: 300px; overflow-y: auto;';
+    
+    entries.forEach(function(entry) {
+        const link = document.createElement('a');
+        link.className = 'd-block px-3 py-2 border-bottom text-dark text-decoration-none';
+        link.href = entry.item.url;
+        
+        const icon = document.createElement('i');
+        icon.className = `fas ${entry.icon} me-2 text-primary`;
+        link.appendChild(icon);
+        link.appendChild(document.createTextNode(entry.item.name));
+        suggestionsDiv.appendChild(link);
+    });
     
+    input.parentNode.style.position = 'relative';
+    input.parentNode.appendChild(suggestionsDiv);
+}
+
+// Filter products
+function filterProducts(category) {
+    const currentUrl = new URL(window.location.href);
+    currentUrl.searchParams.set('category', category);
     window.location.href = currentUrl.toString();
 }
 
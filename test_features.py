@@ -205,6 +205,139 @@ def test_order_functionality():
     conn.commit()
     conn.close()
 
+def test_order_cancellation_concurrency():
+    """Test that racing cancellations restock an order exactly once"""
+    print("\n🔁 Testing Concurrent Order Cancellation...")
+    
+    import threading
+    from app import cancel_pending_order, record_order_events
+    
+    def connect():
+        conn = sqlite3.connect('mediplant.db', timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    conn = connect()
+    user = conn.execute("SELECT id FROM users WHERE role = 'user' LIMIT 1").fetchone()
+    product = conn.execute("SELECT id, stock_quantity FROM products LIMIT 1").fetchone()
+    
+    if not user or not product:
+        print("❌ Need test users and products for cancellation testing")
+        conn.close()
+        return
+    
+    # A pending order for 3 units of one product
+    cursor = conn.execute('''
+        INSERT INTO orders (user_id, total_amount, shipping_address, status)
+        VALUES (?, ?, ?, ?)
+    ''', (user['id'], 300.00, "Test Address", "pending"))
+    order_id = cursor.lastrowid
+    conn.execute('''
+        INSERT INTO order_items (order_id, product_id, quantity, price)
+        VALUES (?, ?, ?, ?)
+    ''', (order_id, product['id'], 3, 100.00))
+    # Same creation event and status counter entry place_order records
+    record_order_events(conn, [(order_id, None, 'pending', 300.00, None, user['id'])])
+    conn.commit()
+    
+    # Eight customers/admins cancel at the same moment
+    results = []
+    barrier = threading.Barrier(8)
+    
+    def cancel():
+        worker_conn = connect()
+        barrier.wait()
+        results.append(cancel_pending_order(worker_conn, order_id, 'Concurrency test'))
+        worker_conn.close()
+    
+    threads = [threading.Thread(target=cancel) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    winners = [result for result in results if result is not None]
+    stock = conn.execute('SELECT stock_quantity FROM products WHERE id = ?', (product['id'],)).fetchone()[0]
+    status = conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()[0]
+    
+    if len(winners) == 1 and stock == product['stock_quantity'] + 3 and status == 'cancelled':
+        print("✅ Cancellation - Exactly one of 8 concurrent cancels restocked the order")
+    else:
+        print(f"❌ Cancellation - {len(winners)} cancels succeeded, stock changed by {stock - product['stock_quantity']}")
+    
+    # A repeated cancel is a no-op
+    if cancel_pending_order(conn, order_id, 'Repeat') is None:
+        print("✅ Cancellation - Repeated cancel is a no-op")
+    else:
+        print("❌ Cancellation - Repeated cancel changed the order again")
+    
+    # Put the stock back as it was
+    conn.execute('UPDATE products SET stock_quantity = stock_quantity - 3 WHERE id = ?', (product['id'],))
+    conn.commit()
+    conn.close()
+
+def test_exhausted_coupon_order():
+    """Test that an order is stopped when its coupon runs out before it is placed"""
+    print("\n🎟️ Testing Exhausted Coupon at Checkout...")
+    
+    from app import app, invalidate_promotions
+    
+    conn = sqlite3.connect('mediplant.db', timeout=30)
+    user = conn.execute("SELECT id FROM users WHERE username = 'demo'").fetchone()
+    product = conn.execute("SELECT id FROM products WHERE is_active = 1 AND stock_quantity > 0 LIMIT 1").fetchone()
+    
+    if not user or not product:
+        print("❌ Need the demo user and a product in stock for coupon testing")
+        conn.close()
+        return
+    
+    user_id = user[0]
+    saved_cart = conn.execute('SELECT product_id, quantity FROM cart WHERE user_id = ?', (user_id,)).fetchall()
+    conn.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
+    conn.execute('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, 1)', (user_id, product[0]))
+    cursor = conn.execute('''
+        INSERT INTO promotions (code, description, kind, value, max_redemptions)
+        VALUES ('TESTLASTONE', 'Test coupon with one use left', 'percent', 10, 1)
+    ''')
+    promotion_id = cursor.lastrowid
+    conn.commit()
+    orders_before = conn.execute('SELECT COUNT(*) FROM orders WHERE user_id = ?', (user_id,)).fetchone()[0]
+    
+    client = app.test_client()
+    client.post('/login', data={'username': 'demo', 'password': 'demo123'})
+    client.post('/apply_coupon', data={'code': 'TESTLASTONE'})
+    
+    # Another customer's order takes the last use between checkout and placing this one
+    conn.execute('UPDATE promotions SET redemptions = 1 WHERE id = ?', (promotion_id,))
+    conn.commit()
+    invalidate_promotions()
+    
+    response = client.post('/place_order', data={
+        'shipping_address': 'Test Address', 'city': 'Pune', 'state': 'Maharashtra',
+        'postal_code': '411001', 'phone': '9999999999'
+    })
+    orders_after = conn.execute('SELECT COUNT(*) FROM orders WHERE user_id = ?', (user_id,)).fetchone()[0]
+    with client.session_transaction() as session:
+        coupon_kept = 'coupon_code' in session
+    
+    if response.status_code == 302 and response.headers['Location'].endswith('/cart') and orders_after == orders_before:
+        print("✅ Coupons - Order with a used-up coupon is sent back to the cart")
+    else:
+        print(f"❌ Coupons - Order went through at full price ({orders_after - orders_before} placed)")
+    
+    if not coupon_kept:
+        print("✅ Coupons - Used-up coupon removed from the session")
+    else:
+        print("❌ Coupons - Used-up coupon still in the session")
+    
+    # Put the cart back as it was
+    conn.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
+    conn.executemany('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)',
+                     [(user_id, product_id, quantity) for product_id, quantity in saved_cart])
+    conn.execute('DELETE FROM promotions WHERE id = ?', (promotion_id,))
+    conn.commit()
+    conn.close()
+
 def test_admin_functionality():
     """Test admin operations"""
     print("\n👑 Testing Admin Functionality...")
@@ -310,6 +443,8 @@ if __name__ == "__main__":
     test_route_accessibility()
     test_cart_functionality()
     test_order_functionality()
+    test_order_cancellation_concurrency()
+    test_exhausted_coupon_order()
     test_admin_functionality()
     test_wishlist_functionality()
     
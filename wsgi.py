@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Production entry point for MediPlant
+- Creates the schema and warms the search and facet indexes, then forks the workers
+- Each worker serves requests on a fixed pool of threads from the shared listening socket
+- Debug mode and the reloader stay off; SIGTERM / Ctrl+C let in-flight requests finish
+- Pure Python (werkzeug's server), so it runs offline and without extra packages
+- Workers cache the catalog separately and catch up with each other's writes through
+  the catalog_changes table (see sync_catalog_changes in app.py)
+
+    python wsgi.py
+    python wsgi.py --workers 4 --threads 8 --port 8000
+
+Settings can also come from MEDIPLANT_HOST, MEDIPLANT_PORT, MEDIPLANT_WORKERS,
+MEDIPLANT_THREADS and MEDIPLANT_GRACEFUL_TIMEOUT. Other WSGI servers can load
+`wsgi:application` after running `python -c "from app import init_db; init_db()"`.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+import app as webapp
+
+application = webapp.app
+
+KEEPALIVE_TIMEOUT = 15  # seconds an idle connection may hold a worker thread
+RESPAWN_DELAY = 1  # seconds to wait before replacing a worker that died right after starting
+
+class RequestHandler(WSGIRequestHandler):
+    timeout = KEEPALIVE_TIMEOUT
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug server that handles connections on a fixed pool of threads"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None, multiprocess=False):
+        self.multiprocess = multiprocess
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        # Stop accepting while every thread is busy so queued connections go to an idle worker
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        # Called by serve_forever on the way out: let in-flight requests finish first
+        if getattr(self, 'pool', None) is not None:
+            self.pool.shutdown(wait=True)
+        super().server_close()
+
+def prepare_database():
+    """Create or migrate the schema and switch to WAL so workers can read while one writes"""
+    webapp.init_db()
+    conn = sqlite3.connect(webapp.DATABASE)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.close()
+    webapp.build_search_index()
+    webapp.build_facet_index()
+
+def serve_worker(sock, threads, multiprocess):
+    """Serve from the listening socket until SIGTERM or SIGINT, then drain and flush"""
+    webapp.init_worker()
+    server = PooledWSGIServer(sock.getsockname()[0], sock.getsockname()[1], application,
+                              threads, fd=sock.fileno(), multiprocess=multiprocess)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever, which runs on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    finally:
+        webapp.shutdown_worker()
+
+def spawn_worker(sock, threads):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    code = 0
+    try:
+        # Drop the parent's handlers until serve_worker installs its own
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        serve_worker(sock, threads, multiprocess=True)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        # Never fall back into the parent's loop
+        os._exit(code)
+
+def serve(host, port, workers, threads, graceful_timeout):
+    prepare_database()
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=128)
+    print(f"MediPlant serving on http://{host}:{port} "
+          f"({workers} worker{'s' if workers != 1 else ''} x {threads} threads)")
+
+    if workers == 1 or not hasattr(os, 'fork'):
+        if workers != 1:
+            print("Worker processes need os.fork; serving from a single process")
+        serve_worker(sock, threads, multiprocess=False)
+        sock.close()
+        return
+
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        print(f"Shutting down {len(children)} workers (up to {graceful_timeout}s for open requests)")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(graceful_timeout)
+
+    def kill_remaining(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGALRM, kill_remaining)
+
+    for _ in range(workers):
+        children[spawn_worker(sock, threads)] = time.time()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; starting a new one")
+        if time.time() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+        if not stopping:
+            children[spawn_worker(sock, threads)] = time.time()
+
+    signal.alarm(0)
+    sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run MediPlant with worker processes and threads')
+    parser.add_argument('--host', default=os.environ.get('MEDIPLANT_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MEDIPLANT_PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('MEDIPLANT_WORKERS', 2)),
+                        help='server processes (one on systems without fork)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('MEDIPLANT_THREADS', 8)),
+                        help='request threads per worker')
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=int(os.environ.get('MEDIPLANT_GRACEFUL_TIMEOUT', 30)),
+                        help='seconds workers get to finish open requests on shutdown')
+    args = parser.parse_args()
+    if args.workers < 1 or args.threads < 1:
+        parser.error('--workers and --threads must be at least 1')
+
+    serve(args.host, args.port, args.workers, args.threads, args.graceful_timeout)
+
+if __name__ == '__main__':
+    main()